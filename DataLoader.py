@@ -1,85 +1,336 @@
 import numpy as np
 import time
 import torch
-from torch.utils.data import Dataset, TensorDataset, DataLoader, RandomSampler, SequentialSampler
+import torch.distributed as dist
+from torch.utils.data import Dataset, IterableDataset, TensorDataset, DataLoader, RandomSampler, SequentialSampler, Sampler
+from torch.utils.data.dataloader import default_collate
+from torch.nn.utils.rnn import pad_sequence
+
+from feature_store import FeatureStore, LazyWindows
 
 class MyDataset(Dataset):
     def __init__(self, input_ids, input_mask, segment_ids,
-                 start_positions=None, end_positions=None, switches=None, answer_mask=None,
-                 is_training=False):
+                 start_positions=None, end_positions=None, switches=None, answer_offsets=None,
+                 is_training=False, seq_lengths=None):
 
-        self.input_ids, self.input_mask, self.segment_ids = [torch.cat([i.squeeze(0) \
-                for i in input], 0) for input in [input_ids, input_mask, segment_ids]]
+        # Arrays may be `np.memmap`s; rows are only read (and copied) in `__getitem__`,
+        # keeping their (narrow) dtypes. Answers are flat arrays, the answers of
+        # the i-th feature being `answer_offsets[i]:answer_offsets[i+1]`; rows
+        # return them without padding (see `collate_features`).
+        # The dataset holds no sampling state (see `BalancedSampler`), so it can be
+        # used from several DataLoader workers.
+        self.input_ids, self.input_mask, self.segment_ids = input_ids, input_mask, segment_ids
+        self.seq_lengths = seq_lengths
         self.is_training = is_training
 
         if is_training:
-            self.start_positions, self.end_positions, self.switches, self.answer_mask = [torch.cat([i.squeeze(0) \
-                for i in input], 0) for input in [start_positions, end_positions, switches, answer_mask]]
-            indices1, indices2 = [], []
-            for i in range(self.input_ids.size(0)):
-                switch = [s for (s, m) in zip(self.switches[i], self.answer_mask[i]) if m==1]
-                if 3 in switch:
-                    indices2.append(i)
-                else:
-                    indices1.append(i)
-            indices = np.random.permutation(range(len(indices2)))
-            indices2 = [indices2[i] for i in indices]
-            self.positive_indices = indices1
-            self.negative_indices = indices2
-            self.negative_indices_offset = 0
-            self.length = 2*len(self.positive_indices)
+            self.start_positions, self.end_positions, self.switches, self.answer_offsets = \
+                    start_positions, end_positions, switches, answer_offsets
         else:
-            self.example_index = torch.arange(self.input_ids.size(0), dtype=torch.long)
-            self.length = self.input_ids.size(0)
+            self.example_index = np.arange(self.input_ids.shape[0])
+        self.length = self.input_ids.shape[0]
 
     def __len__(self):
         return self.length
 
+    def get_seq_length(self, idx):
+        """Number of non-padding tokens of the `idx`-th feature."""
+        return int(self.seq_lengths[idx])
+
     def __getitem__(self, idx):
         if self.is_training:
-            if idx%2==0:
-                idx=self.positive_indices[int(idx/2)]
-            else:
-                if self.negative_indices_offset==len(self.positive_indices):
-                    indices = np.random.permutation(range(len(self.negative_indices)))
-                    self.negative_indices = [self.negative_indices[i] for i in indices]
-                    self.negative_indices_offset = 0
-                else:
-                    self.negative_indices_offset+=1
-                idx = self.negative_indices[int(idx/2)]
-            return [b[idx] for b in [self.input_ids, self.input_mask, self.segment_ids,
-                                     self.start_positions, self.end_positions, self.switches, self.answer_mask]]
-        return [b[idx] for b in [self.input_ids, self.input_mask, self.segment_ids,
-                                     self.example_index]]
+            start, end = self.answer_offsets[idx], self.answer_offsets[idx+1]
+            return [torch.from_numpy(np.array(b[idx])) for b in \
+                    [self.input_ids, self.input_mask, self.segment_ids]] + \
+                   [torch.from_numpy(np.array(b[start:end])) for b in \
+                    [self.start_positions, self.end_positions, self.switches]]
+        return [torch.from_numpy(np.array(b[idx])) for b in \
+                [self.input_ids, self.input_mask, self.segment_ids, self.example_index]]
 
+    def __getstate__(self):
+        # Workers started with `spawn` get a pickled copy of the dataset: memory-mapped
+        # columns are sent as their file location and mapped again, not copied.
+        state = dict(self.__dict__)
+        for key, value in state.items():
+            if isinstance(value, np.memmap) and value.filename is not None and value.base is not None:
+                state[key] = _MappedArray(value)
+        return state
 
-class MyDataLoader(DataLoader):
+    def __setstate__(self, state):
+        for key, value in state.items():
+            if isinstance(value, _MappedArray):
+                state[key] = value.open()
+        self.__dict__.update(state)
 
-    def __init__(self, features, batch_size, is_training):
-        all_input_ids = [torch.tensor([f.input_ids for f in _features], dtype=torch.long) \
-                                for _features in features]
-        all_input_mask = [torch.tensor([f.input_mask for f in _features], dtype=torch.long) \
-                                for _features in features]
-        all_segment_ids = [torch.tensor([f.segment_ids for f in _features], dtype=torch.long) \
-                                for _features in features]
 
-        if is_training:
-            all_start_positions = [torch.tensor([f.start_position for f in _features], dtype=torch.long) \
-                                        for _features in features]
-            all_end_positions = [torch.tensor([f.end_position for f in _features], dtype=torch.long) \
-                                        for _features in features]
-            all_switches = [torch.tensor([f.switch for f in _features], dtype=torch.long) \
-                                        for _features in features]
-            all_answer_mask = [torch.tensor([f.answer_mask for f in _features], dtype=torch.long) \
-                                        for _features in features]
-            dataset = MyDataset(all_input_ids, all_input_mask, all_segment_ids,
-                    all_start_positions, all_end_positions, all_switches, all_answer_mask,
-                    is_training=is_training)
-            sampler=RandomSampler(dataset)
+class LazyWindowDataset(MyDataset):
+    """Training windows built in `__getitem__` from a `LazyWindows`, rather than
+    read from materialized feature columns."""
+
+    def __init__(self, windows):
+        self.windows = windows
+        self.seq_lengths = windows.seq_lengths
+        self.is_training = True
+        self.length = len(windows)
+
+    def __getitem__(self, idx):
+        return [torch.from_numpy(b) for b in self.windows.row(idx)]
+
+
+class _MappedArray(object):
+
+    def __init__(self, array):
+        self.filename = array.filename
+        self.dtype = array.dtype
+        self.shape = array.shape
+        self.offset = array.offset
+
+    def open(self):
+        return np.memmap(self.filename, dtype=self.dtype, mode='r', shape=self.shape,
+                         offset=self.offset)
+
+
+class BalancedSampler(Sampler):
+    """Draws every positive feature once per epoch, together with as many
+    negatives, in random order.
+
+    Negatives are taken from a shuffled list of all negatives which is cycled
+    through across epochs, so all of them are eventually used. The order only
+    depends on `seed` (an int or a tuple of ints) and the epoch set with
+    `set_epoch`, which makes it reproducible and independent of the number of
+    DataLoader workers.
+    """
+
+    def __init__(self, positive_indices, negative_indices, seed=0):
+        self.positive_indices = np.asarray(positive_indices)
+        self.negative_indices = np.asarray(negative_indices)
+        self.seed = list(np.atleast_1d(seed))
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _negatives(self, n_positives):
+        # Negatives used in epochs `0..epoch` are consecutive pieces of a stream
+        # made of one permutation of all negatives after another.
+        n_negatives = len(self.negative_indices)
+        start = self.epoch * n_positives
+        negatives = []
+        for cycle in range(start // n_negatives, (start + n_positives - 1) // n_negatives + 1):
+            rng = np.random.RandomState(self.seed + [cycle])
+            negatives.append(self.negative_indices[rng.permutation(n_negatives)])
+        negatives = np.concatenate(negatives)
+        offset = start % n_negatives
+        return negatives[offset:offset+n_positives]
+
+    def __iter__(self):
+        n_positives = len(self.positive_indices)
+        indices = self.positive_indices
+        if len(self.negative_indices) > 0 and n_positives > 0:
+            indices = np.concatenate([indices, self._negatives(n_positives)])
+        rng = np.random.RandomState(self.seed + [self.epoch, 1])
+        return iter(indices[rng.permutation(len(indices))].tolist())
+
+    def __len__(self):
+        if len(self.negative_indices) > 0:
+            return 2 * len(self.positive_indices)
+        return len(self.positive_indices)
+
+
+class StreamingDataset(IterableDataset):
+    """Streams the training features of several `FeatureStore`s (given as saved
+    paths or as stores) without loading them into memory.
+
+    Shards are visited in a random order and balanced like `BalancedSampler`
+    does; the resulting stream is shuffled through a buffer of `shuffle_buffer`
+    features. The features of each shard are split between distributed ranks
+    and DataLoader workers, so every process reads its own part of them. Like
+    `DistributedSampler`, a few features are repeated so that all parts have the
+    same size, and every rank runs the same number of steps. The order depends
+    only on `seed` and the epoch, which is read when iteration starts.
+    """
+
+    def __init__(self, shards, shuffle_buffer=1000, seed=0):
+        self.shards = shards
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        # Read here, like `DistributedSampler` does: DataLoader workers started
+        # with `spawn` do not see the process group.
+        self.rank, self.world_size = 0, 1
+        if dist.is_available() and dist.is_initialized():
+            self.rank, self.world_size = dist.get_rank(), dist.get_world_size()
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _split(self):
+        worker = torch.utils.data.get_worker_info()
+        num_workers, worker_id = (1, 0) if worker is None else (worker.num_workers, worker.id)
+        return self.rank * num_workers + worker_id, self.world_size * num_workers
+
+    def _iter_shard(self, shard_index, split, n_splits):
+        store = self.shards[shard_index]
+        if isinstance(store, str):
+            store = FeatureStore.load(store)
+        columns = store.columns
+        dataset = MyDataset(columns['input_ids'], columns['input_mask'], columns['segment_ids'],
+                            columns['start_position'], columns['end_position'], columns['switch'],
+                            columns['answer_offsets'], is_training=True, seq_lengths=columns['seq_length'])
+        sampler = BalancedSampler(_split_evenly(store.positive_indices, split, n_splits),
+                                  _split_evenly(store.negative_indices, split, n_splits),
+                                  seed=(self.seed, shard_index))
+        sampler.set_epoch(self.epoch)
+        for idx in sampler:
+            yield dataset[idx]
+
+    def __iter__(self):
+        split, n_splits = self._split()
+        shard_order = np.random.RandomState([self.seed, self.epoch]).permutation(len(self.shards))
+        rng = np.random.RandomState([self.seed, self.epoch, split])
+        buffer = []
+        for shard_index in shard_order:
+            for item in self._iter_shard(shard_index, split, n_splits):
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append(item)
+                    continue
+                i = rng.randint(len(buffer))
+                yield buffer[i]
+                buffer[i] = item
+        for i in rng.permutation(len(buffer)):
+            yield buffer[i]
+
+
+def _split_evenly(indices, split, n_splits):
+    """The `split`-th of `n_splits` equal-sized parts of `indices`; indices from
+    the start are repeated to fill the last parts."""
+    if len(indices) == 0:
+        return indices
+    total_size = -(-len(indices) // n_splits) * n_splits
+    return np.resize(indices, total_size)[split::n_splits]
+
+
+class BucketBatchSampler(Sampler):
+    """Batches the indices drawn from `sampler` so that each batch holds features
+    of similar length.
+
+    Indices are taken `batch_size * pool_size` at a time, sorted by length and cut
+    into batches; with `shuffle`, the batches of a pool are yielded in random
+    order, which depends only on `seed` and the epoch. Since `sampler` still
+    decides which indices are drawn, the positive/negative balance of
+    `BalancedSampler` is kept.
+    """
+
+    def __init__(self, sampler, get_seq_length, batch_size, pool_size=50, shuffle=True, seed=0):
+        self.sampler = sampler
+        self.get_seq_length = get_seq_length
+        self.batch_size = batch_size
+        self.pool_size = pool_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        rng = np.random.RandomState([self.seed, self.epoch, 2])
+        pool = []
+        for idx in self.sampler:
+            pool.append(idx)
+            if len(pool) == self.batch_size * self.pool_size:
+                for batch in self._split(pool, rng):
+                    yield batch
+                pool = []
+        for batch in self._split(pool, rng):
+            yield batch
+
+    def _split(self, pool, rng):
+        pool = sorted(pool, key=self.get_seq_length)
+        batches = [pool[i:i+self.batch_size] for i in range(0, len(pool), self.batch_size)]
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def __len__(self):
+        return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+
+
+def collate_features(rows):
+    """Like `default_collate`, except for the unpadded answers of training rows:
+    `start_positions`, `end_positions` and `switch` are padded to the largest
+    number of answers in the batch and followed by their `answer_mask`. Every
+    tensor has one row per feature, so `nn.DataParallel` can split the batch."""
+    if len(rows[0]) == 4:
+        return default_collate(rows)
+    batch = default_collate([row[:3] for row in rows])
+    answers = [pad_sequence([row[i] for row in rows], batch_first=True) for i in range(3, 6)]
+    answer_mask = pad_sequence([torch.ones(len(row[3]), dtype=torch.uint8) for row in rows],
+                               batch_first=True)
+    return batch + answers + [answer_mask]
+
+
+def collate_trimmed(rows):
+    """Like `collate_features`, but cuts `input_ids`, `input_mask` and `segment_ids`
+    to the longest sequence of the batch instead of `max_seq_length`."""
+    batch = collate_features(rows)
+    max_length = int(batch[1].sum(1).max())
+    return [t[:, :max_length] for t in batch[:3]] + batch[3:]
+
+
+class MyDataLoader(DataLoader):
+
+    def __init__(self, store, batch_size, is_training, dynamic_padding=False, seed=0,
+                 num_workers=0, prefetch_factor=2, persistent_workers=False):
+        # `store` is a `FeatureStore`, or the `LazyWindows` of `--lazy_windows` training.
+        columns = getattr(store, 'columns', None)
+        if isinstance(store, LazyWindows):
+            dataset = LazyWindowDataset(store)
+            sampler = BalancedSampler(store.positive_indices, store.negative_indices, seed=seed)
+        elif is_training:
+            dataset = MyDataset(columns['input_ids'], columns['input_mask'], columns['segment_ids'],
+                    columns['start_position'], columns['end_position'], columns['switch'], columns['answer_offsets'],
+                    is_training=is_training, seq_lengths=columns['seq_length'])
+            sampler = BalancedSampler(store.positive_indices, store.negative_indices, seed=seed)
         else:
-            dataset = MyDataset(all_input_ids, all_input_mask, all_segment_ids,
-                                is_training=is_training)
+            dataset = MyDataset(columns['input_ids'], columns['input_mask'], columns['segment_ids'],
+                                is_training=is_training, seq_lengths=columns['seq_length'])
             sampler=SequentialSampler(dataset)
 
-        super(MyDataLoader, self).__init__(dataset, sampler=sampler, batch_size=batch_size)
+        kwargs = dict(num_workers=num_workers)
+        if num_workers > 0:
+            kwargs.update(prefetch_factor=prefetch_factor, persistent_workers=persistent_workers)
+        if dynamic_padding:
+            batch_sampler = BucketBatchSampler(sampler, dataset.get_seq_length, batch_size,
+                                               shuffle=is_training, seed=seed)
+            super(MyDataLoader, self).__init__(dataset, batch_sampler=batch_sampler,
+                                               collate_fn=collate_trimmed, **kwargs)
+        else:
+            super(MyDataLoader, self).__init__(dataset, sampler=sampler, batch_size=batch_size,
+                                               collate_fn=collate_features, **kwargs)
+
+    def set_epoch(self, epoch):
+        """Selects the (deterministic) order of the training features for `epoch`."""
+        for sampler in [self.sampler, self.batch_sampler]:
+            if hasattr(sampler, 'set_epoch'):
+                sampler.set_epoch(epoch)
+
+
+class StreamingDataLoader(DataLoader):
+    """Training batches streamed from all `shards` (see `StreamingDataset`)."""
+
+    def __init__(self, shards, batch_size, shuffle_buffer=1000, dynamic_padding=False, seed=0,
+                 num_workers=0, prefetch_factor=2):
+        dataset = StreamingDataset(shards, shuffle_buffer=shuffle_buffer, seed=seed)
+        kwargs = dict(num_workers=num_workers)
+        if num_workers > 0:
+            # Workers are not persistent, so that each epoch's iterator gets the
+            # dataset with its current epoch.
+            kwargs.update(prefetch_factor=prefetch_factor)
+        kwargs.update(collate_fn=collate_trimmed if dynamic_padding else collate_features)
+        super(StreamingDataLoader, self).__init__(dataset, batch_size=batch_size, **kwargs)
 
+    def set_epoch(self, epoch):
+        self.dataset.set_epoch(epoch)
@@ -0,0 +1,350 @@
+"""Micro-benchmarks for the preprocessing and model code.
+
+Example:
+    python benchmark.py wordpiece --vocab_file uncased_L-12_H-768_A-12/vocab.txt \
+        --input_file preprocessed-open-domain-qa-data/nq-dev.json
+    python benchmark.py padding --input_file preprocessed-open-domain-qa-data/nq-train0.json
+    python benchmark.py nq_parsing --input_file v1.0/dev/nq-dev-00.jsonl.gz
+    python benchmark.py loss --max_seq_length 300 --batch_size 64
+    python benchmark.py attention --bert_config_file uncased_L-12_H-768_A-12/bert_config.json
+    python benchmark.py encoder --bert_config_file uncased_L-12_H-768_A-12/bert_config.json
+"""
+
+import argparse
+import json
+import logging
+import time
+
+import numpy as np
+import torch
+
+import tokenization
+
+
+def _memory_status():
+    status = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            key, value = line.split(':', 1)
+            if key in ['VmRSS', 'VmHWM']:
+                status[key] = int(value.split()[0]) * 1024
+    return status
+
+
+def _peak_memory(fn):
+    """Runs `fn` and returns by how many bytes it raised the peak resident memory
+    of the process (Linux only: None elsewhere)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            # Resets the peak resident memory (VmHWM) to the current one.
+            f.write('5')
+    except (IOError, OSError):
+        fn()
+        return None
+    start = _memory_status()['VmRSS']
+    fn()
+    return _memory_status()['VmHWM'] - start
+
+
+def _timeit(fn, n_repeats):
+    best = None
+    for _ in range(n_repeats):
+        start = time.time()
+        output = fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, output
+
+
+def benchmark_wordpiece(args):
+    """Compares the trie-based WordPiece search against the substring lookup on
+    the whitespace tokens of the paragraphs in `--input_file`."""
+    vocab = tokenization.load_vocab(args.vocab_file)
+    words = []
+    with open(args.input_file, "r") as f:
+        for i, line in enumerate(f):
+            if i == args.max_examples:
+                break
+            for paragraph in json.loads(line)['context']:
+                words += paragraph
+    print("%d paragraph tokens (%d distinct)" % (len(words), len(set(words))))
+
+    # The memo cache is disabled so that only the longest-match search is timed.
+    outputs = {}
+    for use_trie in [False, True]:
+        wordpiece_tokenizer = tokenization.WordpieceTokenizer(vocab=vocab, use_trie=use_trie)
+        elapsed, outputs[use_trie] = _timeit(
+            lambda: [wordpiece_tokenizer.tokenize(word) for word in words], args.n_repeats)
+        print("%-10s %.3fs (%.0f words/s)" % ("trie" if use_trie else "substring",
+                                             elapsed, len(words) / elapsed))
+    assert outputs[False] == outputs[True], "trie output differs from the substring search"
+
+
+def benchmark_nq_parsing(args):
+    """Compares full `json.loads` parsing of the NQ shard `--input_file` against
+    the lazy parsing of `split_nq.py`."""
+    from split_nq import prepro_shard
+    outputs = {}
+    for lazy_parsing in [False, True]:
+        elapsed, outputs[lazy_parsing] = _timeit(
+            lambda: prepro_shard(args.input_file, lazy_parsing=lazy_parsing), args.n_repeats)
+        print("%-10s %.3fs (%d questions with short answers)" % (
+            "lazy" if lazy_parsing else "full", elapsed, len(outputs[lazy_parsing])))
+    assert outputs[False] == outputs[True], "lazy parsing output differs from full parsing"
+
+
+def _load_train_store(args, tokenizer):
+    from prepro import iter_squad_examples, iter_features
+    from feature_store import FeatureStore
+    logger = logging.getLogger(__name__)
+    prepro_args = argparse.Namespace(verbose=False, num_prepro_workers=1)
+    examples = iter_squad_examples(logger, prepro_args, args.input_file, debug=False)
+    examples = (example for (i, example) in enumerate(examples) if i < args.max_examples)
+    features = iter_features(logger, prepro_args, examples, tokenizer, args.max_seq_length,
+                             doc_stride=128, max_query_length=64, max_n_answers=args.max_n_answers,
+                             is_training=True)
+    return FeatureStore.from_features(list(features), args.max_seq_length, args.max_n_answers,
+                                      is_training=True, vocab_size=len(tokenizer.vocab))
+
+
+def benchmark_padding(args):
+    """Training throughput (real tokens per second, forward + backward) with
+    batches padded to `max_seq_length` vs. length-bucketed dynamic padding."""
+    from DataLoader import MyDataLoader
+    from modeling import BertConfig, BertForQuestionAnswering
+
+    tokenizer = tokenization.FullTokenizer(vocab_file=args.vocab_file)
+    store = _load_train_store(args, tokenizer)
+    config = BertConfig.from_json_file(args.bert_config_file)
+    torch.manual_seed(args.seed)
+    model = BertForQuestionAnswering(config, torch.device("cpu"), 4, loss_type="mml")
+    model.train()
+
+    for dynamic_padding in [False, True]:
+        np.random.seed(args.seed)
+        dataloader = MyDataLoader(store, args.batch_size, is_training=True,
+                                  dynamic_padding=dynamic_padding, seed=args.seed)
+        n_batches, n_tokens, n_padded, elapsed = 0, 0, 0, 0.0
+        for batch in dataloader:
+            if n_batches == args.n_batches:
+                break
+            start = time.time()
+            loss = model([t.long() for t in batch])
+            loss.backward()
+            model.zero_grad()
+            elapsed += time.time() - start
+            n_batches += 1
+            n_tokens += int(batch[1].sum())
+            n_padded += batch[0].numel()
+        print("%-16s %d batches, %.1f%% padding, %.0f tokens/s" % (
+            "dynamic padding" if dynamic_padding else "fixed padding", n_batches,
+            100.0 * (n_padded - n_tokens) / n_padded, n_tokens / elapsed))
+
+
+def _reference_loss(start_logits, end_logits, switch_logits, answers, loss_type, use_min):
+    """The loss as computed before `BertForQuestionAnswering.compute_loss`: one
+    `CrossEntropyLoss` per answer slot (checks the vectorized loss against it)."""
+    from torch.nn import CrossEntropyLoss
+    start_positions, end_positions, switch, answer_mask = [t.clone() for t in answers]
+    ignored_index = start_logits.size(1)
+    start_positions.clamp_(0, ignored_index)
+    end_positions.clamp_(0, ignored_index)
+    answer_mask = answer_mask.float()
+    loss_fct = CrossEntropyLoss(ignore_index=ignored_index, reduction='none')
+    span_mask = answer_mask * (switch == 0).float()
+    start_losses = [loss_fct(start_logits, p) * m for (p, m) in
+                    zip(torch.unbind(start_positions, dim=1), torch.unbind(span_mask, dim=1))]
+    end_losses = [loss_fct(end_logits, p) * m for (p, m) in
+                  zip(torch.unbind(end_positions, dim=1), torch.unbind(span_mask, dim=1))]
+    switch_losses = [loss_fct(switch_logits, s) * m for (s, m) in
+                     zip(torch.unbind(switch, dim=1), torch.unbind(answer_mask, dim=1))]
+    loss_tensor = torch.cat([t.unsqueeze(1) for t in start_losses], dim=1) + \
+            torch.cat([t.unsqueeze(1) for t in end_losses], dim=1) + \
+            torch.cat([t.unsqueeze(1) for t in switch_losses], dim=1)
+    if loss_type == 'first-only':
+        return torch.sum(start_losses[0] + end_losses[0] + switch_losses[0])
+    if use_min:
+        return torch.sum(torch.min(loss_tensor + 2 * torch.max(loss_tensor) * (loss_tensor == 0).float(), 1)[0])
+    return -torch.sum(torch.log(torch.sum(torch.exp(-loss_tensor - 1e10 * (loss_tensor == 0).float()), 1)))
+
+
+def _random_answers(rng, batch_size, max_seq_length, max_n_answers):
+    """Padded answers of a training batch, with 1 to `max_n_answers` answers per
+    row (about a quarter of them with switch 3)."""
+    n_answers = rng.randint(1, max_n_answers + 1, batch_size)
+    answer_mask = (np.arange(max_n_answers)[None] < n_answers[:, None]).astype(np.int64)
+    start_positions = rng.randint(0, max_seq_length, (batch_size, max_n_answers)) * answer_mask
+    end_positions = rng.randint(0, max_seq_length, (batch_size, max_n_answers)) * answer_mask
+    switch = rng.choice([0, 0, 0, 3], (batch_size, max_n_answers)) * answer_mask
+    return [torch.from_numpy(a) for a in [start_positions, end_positions, switch, answer_mask]]
+
+
+def benchmark_loss(args):
+    """Time of the loss (forward + backward, logits only) of the per-slot
+    `CrossEntropyLoss` implementation vs. the vectorized one, for answers padded
+    to `max_n_answers` and to the largest number of answers in the batch (as
+    `collate_features` does), and several `max_n_answers`; also checks that
+    losses and gradients match."""
+    from modeling import BertConfig, BertForQuestionAnswering
+    config = BertConfig(vocab_size=8, hidden_size=8, num_hidden_layers=1, num_attention_heads=1,
+                        intermediate_size=8)
+    rng = np.random.RandomState(args.seed)
+    torch.manual_seed(args.seed)
+    logits = [torch.randn(args.batch_size, args.max_seq_length, requires_grad=True),
+              torch.randn(args.batch_size, args.max_seq_length, requires_grad=True),
+              torch.randn(args.batch_size, 4, requires_grad=True)]
+
+    for max_n_answers in [1, 5, 20, 50]:
+        answers = _random_answers(rng, args.batch_size, args.max_seq_length, max_n_answers)
+        batch_padded_answers = [t[:, :int(answers[3].sum(1).max())] for t in answers]
+
+        for loss_type in ['first-only', 'mml', 'hard-em']:
+            model = BertForQuestionAnswering(config, torch.device("cpu"), 4, loss_type=loss_type, tau=1)
+            # With hard-em, the min is taken at step 1000 and MML at step 0.
+            for global_step in [0, 1000]:
+                np.random.seed(global_step)
+                use_min = loss_type == 'hard-em' and \
+                        np.random.random() < min(global_step / model.tau, 0.8)
+                reference = _reference_loss(*logits, answers, loss_type, use_min)
+                reference_grads = torch.autograd.grad(reference, logits)
+                for given_answers in [answers, batch_padded_answers]:
+                    np.random.seed(global_step)
+                    loss = model.compute_loss(*logits, given_answers, global_step=global_step)
+                    grads = torch.autograd.grad(loss, logits)
+                    assert torch.allclose(loss, reference, rtol=1e-5), (loss_type, loss, reference)
+                    for (grad, reference_grad) in zip(grads, reference_grads):
+                        assert torch.allclose(grad, reference_grad, rtol=1e-4, atol=1e-7), \
+                                "%s gradients differ from the per-slot loss" % loss_type
+
+        model = BertForQuestionAnswering(config, torch.device("cpu"), 4, loss_type="mml")
+        times = []
+        for fn in [lambda: _reference_loss(*logits, answers, "mml", use_min=False),
+                   lambda: model.compute_loss(*logits, answers),
+                   lambda: model.compute_loss(*logits, batch_padded_answers)]:
+            def run():
+                for _ in range(args.n_batches):
+                    fn().backward()
+            times.append(_timeit(run, args.n_repeats)[0] / args.n_batches)
+        print("max_n_answers=%-3d per-slot %.2fms  vectorized %.2fms  batch-padded %.2fms" % (
+            max_n_answers, times[0] * 1000, times[1] * 1000, times[2] * 1000))
+
+
+def benchmark_attention(args):
+    """CPU latency (forward, and forward + backward) and peak memory of
+    `BertModel` with the eager and the `sdpa` attention backends, at sequence
+    lengths 300 and 512; also checks that both backends give the same outputs."""
+    from modeling import BertConfig, BertModel
+    config = BertConfig.from_json_file(args.bert_config_file)
+    torch.manual_seed(args.seed)
+    rng = np.random.RandomState(args.seed)
+
+    for max_seq_length in [300, 512]:
+        input_ids = torch.from_numpy(rng.randint(0, config.vocab_size, (args.batch_size, max_seq_length)))
+        lengths = rng.randint(max_seq_length // 2, max_seq_length + 1, args.batch_size)
+        input_mask = torch.from_numpy((np.arange(max_seq_length)[None] < lengths[:, None]).astype(np.int64))
+        segment_ids = torch.zeros_like(input_ids)
+
+        outputs, state_dict = {}, None
+        for attention_backend in ["eager", "sdpa"]:
+            config.attention_backend = attention_backend
+            model = BertModel(config)
+            if state_dict is None:
+                state_dict = model.state_dict()
+            model.load_state_dict(state_dict)
+            # Dropout is disabled so that both backends compute the same function.
+            model.eval()
+
+            def forward():
+                with torch.no_grad():
+                    return model(input_ids, segment_ids, input_mask)[-1]
+
+            def forward_backward():
+                model(input_ids, segment_ids, input_mask)[-1].sum().backward()
+                model.zero_grad()
+
+            forward_time, outputs[attention_backend] = _timeit(forward, args.n_repeats)
+            train_time, _ = _timeit(forward_backward, args.n_repeats)
+            peak = _peak_memory(forward_backward)
+            print("length %d %-6s forward %.3fs  forward+backward %.3fs  peak memory %s" % (
+                max_seq_length, attention_backend, forward_time, train_time,
+                "n/a" if peak is None else "+%.0fMB" % (peak / 2**20)))
+        assert torch.allclose(outputs["eager"], outputs["sdpa"], atol=1e-4), \
+                "sdpa attention output differs from the eager one"
+
+
+def benchmark_encoder(args):
+    """CPU latency of the forward and backward passes of `BERTEncoder` with the
+    op-by-op LayerNorm/gelu vs. the native ones (`fused_ops`); also checks that
+    both load the same parameters and give the same outputs and gradients."""
+    from modeling import BertConfig, BERTEncoder
+    config = BertConfig.from_json_file(args.bert_config_file)
+    torch.manual_seed(args.seed)
+    rng = np.random.RandomState(args.seed)
+    hidden_states = torch.randn(args.batch_size, args.max_seq_length, config.hidden_size)
+    lengths = rng.randint(args.max_seq_length // 2, args.max_seq_length + 1, args.batch_size)
+    attention_mask = torch.from_numpy(
+        (np.arange(args.max_seq_length)[None] >= lengths[:, None]) * -10000.0).float()[:, None, None]
+
+    outputs, state_dict = {}, None
+    for fused_ops in [False, True]:
+        config.fused_ops = fused_ops
+        encoder = BERTEncoder(config)
+        if state_dict is None:
+            state_dict = encoder.state_dict()
+        # Same parameter names, so the same checkpoints load into both.
+        encoder.load_state_dict(state_dict)
+        encoder.eval()
+        inputs = hidden_states.clone().requires_grad_()
+
+        def forward():
+            with torch.no_grad():
+                return encoder(inputs, attention_mask)[-1]
+
+        def forward_backward():
+            output = encoder(inputs, attention_mask)[-1]
+            inputs.grad = None
+            output.sum().backward()
+            encoder.zero_grad()
+            return output.detach(), inputs.grad
+
+        forward_time, _ = _timeit(forward, args.n_repeats)
+        train_time, outputs[fused_ops] = _timeit(forward_backward, args.n_repeats)
+        print("%-8s forward %.3fs  forward+backward %.3fs" % (
+            "native" if fused_ops else "op-by-op", forward_time, train_time))
+    for (output, fused_output) in zip(outputs[False], outputs[True]):
+        assert torch.allclose(output, fused_output, rtol=1e-4, atol=1e-4), \
+                "native LayerNorm/gelu results differ from the op-by-op ones"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('task', choices=['wordpiece', 'padding', 'nq_parsing', 'loss', 'attention', 'encoder'])
+    parser.add_argument('--vocab_file', type=str, default="uncased_L-12_H-768_A-12/vocab.txt")
+    parser.add_argument('--bert_config_file', type=str, default="uncased_L-12_H-768_A-12/bert_config.json")
+    parser.add_argument('--input_file', type=str)
+    parser.add_argument('--max_examples', type=int, default=200)
+    parser.add_argument('--n_repeats', type=int, default=3)
+    parser.add_argument('--max_seq_length', type=int, default=300)
+    parser.add_argument('--max_n_answers', type=int, default=20)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--n_batches', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    if args.task == 'wordpiece':
+        benchmark_wordpiece(args)
+    elif args.task == 'padding':
+        benchmark_padding(args)
+    elif args.task == 'nq_parsing':
+        benchmark_nq_parsing(args)
+    elif args.task == 'loss':
+        benchmark_loss(args)
+    elif args.task == 'attention':
+        benchmark_attention(args)
+    elif args.task == 'encoder':
+        benchmark_encoder(args)
+
+
+if __name__ == '__main__':
+    main()
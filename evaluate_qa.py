@@ -66,8 +66,9 @@ def write_predictions(logger, all_examples, all_features, all_results, n_best_si
         for (feature_index, feature) in results:
             result = unique_id_to_result[feature.unique_id]
             scores = []
-            start_logits = result.start_logits[:len(feature.tokens)]
-            end_logits = result.end_logits[:len(feature.tokens)]
+            num_tokens = feature.num_tokens
+            start_logits = result.start_logits[:num_tokens]
+            end_logits = result.end_logits[:num_tokens]
             for (i, s) in enumerate(start_logits):
                 for (j, e) in enumerate(end_logits[i:i+10]):
                     scores.append(((i, i+j), s+e))
@@ -76,15 +77,15 @@ def write_predictions(logger, all_examples, all_features, all_results, n_best_si
 
             cnt = 0
             for (start_index, end_index), score in scores:
-                if start_index >= len(feature.tokens):
+                if start_index >= num_tokens:
                     continue
-                if end_index >= len(feature.tokens):
+                if end_index >= num_tokens:
                     continue
-                if start_index not in feature.token_to_orig_map:
+                if feature.orig_index(start_index) is None:
                     continue
-                if end_index not in feature.token_to_orig_map:
+                if feature.orig_index(end_index) is None:
                     continue
-                if not feature.token_is_max_context.get(start_index, False):
+                if not feature.is_max_context(start_index):
                     continue
                 if end_index < start_index:
                     continue
@@ -124,11 +125,10 @@ def write_predictions(logger, all_examples, all_features, all_results, n_best_si
                 else:
                     feature = features[pred.feature_index]
 
-                    tok_tokens = feature.tokens[pred.start_index:(pred.end_index + 1)]
-                    orig_doc_start = feature.token_to_orig_map[pred.start_index]
-                    orig_doc_end = feature.token_to_orig_map[pred.end_index]
+                    tok_text = feature.token_text(pred.start_index, pred.end_index)
+                    orig_doc_start = feature.orig_index(pred.start_index)
+                    orig_doc_end = feature.orig_index(pred.end_index)
                     orig_tokens = feature.doc_tokens[orig_doc_start:(orig_doc_end + 1)]
-                    tok_text = " ".join(tok_tokens)
 
                     # De-tokenize WordPieces that have been split off.
                     tok_text = tok_text.replace(" ##", "")
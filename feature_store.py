@@ -0,0 +1,711 @@
+import os
+import json
+import shutil
+import hashlib
+import pickle as pkl
+
+import numpy as np
+
+from prepro_util import InputFeatures
+
+# Fixed-width columns: one row per feature, padded to `max_seq_length` / `max_n_answers`.
+# Columns use the narrowest dtype that fits (`input_ids` is narrowed further by
+# `ids_dtype` when the vocab size is known); batches are widened to int64 only
+# when they are fed to the model.
+FIXED_COLUMNS = {
+    'unique_id': np.int64,
+    'example_index': np.int32,
+    'paragraph_index': np.int32,
+    'doc_span_index': np.int32,
+    'seq_length': np.int32,
+    'input_ids': np.int32,
+    'input_mask': np.uint8,
+    'segment_ids': np.uint8,
+}
+# Answers of training features, stored flat (only the unmasked ones, without
+# padding to `max_n_answers`) and addressed through `answer_offsets`.
+ANSWER_COLUMNS = {
+    'start_position': np.int16,
+    'end_position': np.int16,
+    'switch': np.uint8,
+}
+# Ragged per-token metadata (only needed to write predictions), stored flat and
+# addressed through `token_offsets`.
+RAGGED_COLUMNS = {
+    'tok_to_orig': np.int32,
+    'max_context': np.bool_,
+}
+OFFSET_COLUMNS = ['answer_offsets', 'token_offsets']
+# Bumped whenever the layout of saved stores changes, so that older ones are rebuilt.
+STORE_VERSION = 2
+
+# Columns of a `ParagraphStore`: one row per example (`query_length`), one row per
+# paragraph (`paragraph_*`, `n_answers`), and flat ids and answers.
+PARAGRAPH_COLUMNS = {
+    'query_length': np.int32,
+    'paragraph_example': np.int32,
+    'paragraph_index': np.int32,
+    'paragraph_length': np.int32,
+    'n_answers': np.int32,
+    'query_ids': np.int32,
+    'paragraph_ids': np.int32,
+    'answer_start': np.int32,
+    'answer_end': np.int32,
+    'answer_switch': np.uint8,
+    'answer_yes_no': np.bool_,
+}
+
+
+class FeatureStore(object):
+    """Columnar storage of `InputFeatures`.
+
+    Features are kept as one array per attribute. A saved store is a directory of
+    `.npy` files which `load` opens with `np.memmap`, so the training data is read
+    straight from the mapped pages without unpickling any Python objects.
+
+    The grouping of features per example (as returned by
+    `convert_examples_to_features`) is kept in `group_offsets`: features of the
+    i-th example are rows `group_offsets[i]:group_offsets[i+1]`.
+    """
+
+    def __init__(self, columns, group_offsets, is_training, examples=None, id_to_token=None,
+                 example_hashes=None, meta=None, positive_indices=None, negative_indices=None,
+                 path=None):
+        self.columns = columns
+        self.path = path
+        self.group_offsets = group_offsets
+        self.is_training = is_training
+        self.examples = examples
+        self.id_to_token = id_to_token
+        self.example_hashes = example_hashes
+        self.meta = meta or {}
+        if is_training and positive_indices is None:
+            positive_indices, negative_indices = partition_negatives(columns['switch'],
+                                                                     columns['answer_offsets'])
+        self.positive_indices = positive_indices
+        self.negative_indices = negative_indices
+
+    @classmethod
+    def from_features(cls, features, max_seq_length, max_n_answers, is_training, examples=None,
+                      vocab_size=None):
+        """Builds an in-memory store from a list of lists of `InputFeatures`."""
+        flat = [f for _features in features for f in _features]
+        group_offsets = np.cumsum([0] + [len(_features) for _features in features]).astype(np.int64)
+        columns, n_tokens, n_answers = _columns_from_features(flat, max_seq_length, max_n_answers,
+                                                              is_training, ids_dtype(vocab_size))
+        if is_training:
+            columns['answer_offsets'] = np.cumsum([0] + n_answers).astype(np.int64)
+        else:
+            columns['token_offsets'] = np.cumsum([0] + n_tokens).astype(np.int64)
+        return cls(columns, group_offsets, is_training, examples=examples)
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, 'meta.json'))
+
+    def save(self, path):
+        """Writes the store to the directory `path`."""
+        writer = FeatureStoreWriter(path, self.is_training)
+        for key, array in self.columns.items():
+            if key not in OFFSET_COLUMNS:
+                writer.append_column(key, array)
+        if self.is_training:
+            writer.n_answers = np.diff(self.columns['answer_offsets']).tolist()
+        else:
+            writer.n_tokens = np.diff(self.columns['token_offsets']).tolist()
+        writer.group_sizes = np.diff(self.group_offsets).tolist()
+        writer.close(examples=self.examples, example_hashes=self.example_hashes, **self.meta)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        columns = {key: np.load(os.path.join(path, key + '.npy'), mmap_mode='r') for key in meta['columns']}
+        group_offsets = np.load(os.path.join(path, 'group_offsets.npy'))
+        examples, example_hashes = None, None
+        if os.path.exists(os.path.join(path, 'examples.pkl')):
+            with open(os.path.join(path, 'examples.pkl'), 'rb') as f:
+                examples = pkl.load(f)
+        if os.path.exists(os.path.join(path, 'example_hashes.npy')):
+            example_hashes = np.load(os.path.join(path, 'example_hashes.npy'))
+        positive_indices, negative_indices = None, None
+        if os.path.exists(os.path.join(path, 'negative_indices.npy')):
+            positive_indices = np.load(os.path.join(path, 'positive_indices.npy'))
+            negative_indices = np.load(os.path.join(path, 'negative_indices.npy'))
+        return cls(columns, group_offsets, meta['is_training'], examples=examples,
+                   example_hashes=example_hashes,
+                   meta={key: meta[key] for key in ['fingerprint', 'input_hash', 'input_stat'] if key in meta},
+                   positive_indices=positive_indices, negative_indices=negative_indices, path=path)
+
+    @property
+    def n_groups(self):
+        return len(self.group_offsets) - 1
+
+    def __len__(self):
+        return len(self.columns['unique_id'])
+
+    def __getitem__(self, index):
+        """Returns the `index`-th feature as an `InputFeatures` whose arrays are
+        views of the stored columns.
+
+        Token strings are recovered from `input_ids` when they are read, so
+        `id_to_token` must be set (see `FullTokenizer.convert_ids_to_tokens`) for
+        `tokens` and `token_text` to work on a store that has token metadata.
+        """
+        return self._feature(index, self.columns)
+
+    def __iter__(self):
+        # Indexing an `np.memmap` is slow for single rows, so iteration reads
+        # rows through plain views of the columns.
+        columns = {key: np.asarray(array) for (key, array) in self.columns.items()}
+        for index in range(len(self)):
+            yield self._feature(index, columns)
+
+    def _feature(self, index, c):
+        kwargs = dict(unique_id=int(c['unique_id'][index]),
+                      example_index=int(c['example_index'][index]),
+                      paragraph_index=int(c['paragraph_index'][index]),
+                      doc_span_index=int(c['doc_span_index'][index]),
+                      input_ids=c['input_ids'][index],
+                      input_mask=c['input_mask'][index],
+                      segment_ids=c['segment_ids'][index])
+        if self.is_training:
+            start, end = c['answer_offsets'][index], c['answer_offsets'][index+1]
+            for key in ANSWER_COLUMNS:
+                kwargs[key] = c[key][start:end]
+            kwargs['answer_mask'] = np.ones(end - start, dtype=np.int8)
+        else:
+            start, end = c['token_offsets'][index], c['token_offsets'][index+1]
+            if self.id_to_token is not None:
+                kwargs['tokens'] = TokenStrings(kwargs['input_ids'][:end-start], self.id_to_token)
+            kwargs['token_to_orig_map'] = c['tok_to_orig'][start:end]
+            kwargs['token_is_max_context'] = c['max_context'][start:end]
+            if self.examples is not None:
+                kwargs['doc_tokens'] = self.examples[kwargs['example_index']].doc_tokens[kwargs['paragraph_index']]
+        return InputFeatures(**kwargs)
+
+    def first_paragraphs(self, n_paragraphs):
+        """Returns a store with only the features of the first `n_paragraphs`
+        paragraphs of each example (features of an example are ordered by
+        paragraph, so these are a prefix of each group)."""
+        keep = np.asarray(self.columns['paragraph_index']) < n_paragraphs
+        if keep.all():
+            return self
+        rows = np.flatnonzero(keep)
+        ragged_keys = ANSWER_COLUMNS if self.is_training else RAGGED_COLUMNS
+        offsets_key = 'answer_offsets' if self.is_training else 'token_offsets'
+        columns = {key: np.asarray(array[rows]) for (key, array) in self.columns.items()
+                   if key not in ragged_keys and key != offsets_key}
+        offsets = self.columns[offsets_key]
+        lengths = np.diff(offsets)[rows]
+        columns[offsets_key] = np.cumsum(np.concatenate([[0], lengths])).astype(np.int64)
+        items = np.repeat(offsets[rows] - columns[offsets_key][:-1], lengths) + \
+                np.arange(columns[offsets_key][-1])
+        for key in ragged_keys:
+            columns[key] = np.asarray(self.columns[key][items])
+        group_offsets = np.concatenate([[0], np.cumsum(keep)]).astype(np.int64)[self.group_offsets]
+        return FeatureStore(columns, group_offsets, self.is_training, examples=self.examples,
+                            id_to_token=self.id_to_token)
+
+    def group(self, group_index):
+        """The features of the `group_index`-th example."""
+        return [self[index] for index in
+                range(self.group_offsets[group_index], self.group_offsets[group_index+1])]
+
+
+class TokenStrings(object):
+    """The token strings of `input_ids`, converted by `id_to_token` only when
+    they are read (predictions only need those of the n-best spans)."""
+
+    def __init__(self, input_ids, id_to_token):
+        self.input_ids = input_ids
+        self.id_to_token = id_to_token
+
+    def __len__(self):
+        return len(self.input_ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.id_to_token(self.input_ids[index].tolist())
+        return self.id_to_token([int(self.input_ids[index])])[0]
+
+    def __iter__(self):
+        return iter(self[:])
+
+
+class FeatureCache(object):
+    """Reuses the features of a previously saved `FeatureStore` for examples whose
+    content did not change, so that only new or edited examples are converted.
+
+    `lookup` must be called once per example, in order: it records the content
+    hash of each example (saved with the new store as `example_hashes`) and
+    returns the saved features of the example, or None if it has to be converted.
+    The caller is responsible for checking that `store` was computed with the
+    same tokenizer and conversion parameters.
+    """
+
+    def __init__(self, store=None):
+        self.store = store
+        self.index = {}
+        if store is not None and store.example_hashes is not None:
+            self.index = {h: i for (i, h) in enumerate(store.example_hashes.tolist())}
+        self.example_hashes = []
+        self.n_hits = 0
+
+    def lookup(self, example):
+        key = example_hash(example)
+        self.example_hashes.append(key)
+        if key not in self.index:
+            return None
+        self.n_hits += 1
+        return self.store.group(self.index[key])
+
+
+class ParagraphStore(object):
+    """Training data saved as the WordPiece ids of each question and paragraph,
+    with the token spans of the answers, instead of one row per window.
+
+    Windows `[CLS] question [SEP] paragraph span [SEP]` are built from it when they
+    are read (see `windows`), so question tokens and overlapping paragraph tokens
+    are stored only once and the store does not depend on `max_seq_length`,
+    `doc_stride`, `max_query_length` or `max_n_answers`. Per-example and
+    per-paragraph columns hold lengths; the flat id and answer columns are
+    addressed through the offsets computed from them.
+    """
+
+    def __init__(self, columns, meta=None, path=None):
+        self.columns = columns
+        self.meta = meta or {}
+        self.path = path
+        self.query_offsets = _offsets(columns['query_length'])
+        self.paragraph_offsets = _offsets(columns['paragraph_length'])
+        self.answer_offsets = _offsets(columns['n_answers'])
+
+    @classmethod
+    def from_paragraphs(cls, items, vocab_size=None, **meta):
+        """Builds an in-memory store from a list of `(query_ids, paragraphs)`
+        pairs, one per example (see `ParagraphStoreWriter.add`)."""
+        return cls(_paragraph_columns(items, 0, ids_dtype(vocab_size)), meta=meta)
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, 'meta.json'))
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        columns = {key: np.load(os.path.join(path, key + '.npy'), mmap_mode='r') for key in meta.pop('columns')}
+        return cls(columns, meta=meta, path=path)
+
+    @property
+    def n_groups(self):
+        return len(self.columns['query_length'])
+
+    def windows(self, max_seq_length, doc_stride, max_query_length, max_n_answers):
+        return LazyWindows(self, max_seq_length, doc_stride, max_query_length, max_n_answers)
+
+    def __getstate__(self):
+        # DataLoader workers started with `spawn` open a saved store again
+        # instead of receiving a copy of it.
+        if self.path is not None:
+            return {'path': self.path}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if 'columns' not in state:
+            state = ParagraphStore.load(state['path']).__dict__
+        self.__dict__.update(state)
+
+
+class LazyWindows(object):
+    """The training windows of a `ParagraphStore`, built row by row by `row`.
+
+    Only the paragraph, start and length of each window are computed upfront,
+    for all paragraphs at once, together with the positive/negative partition
+    of the windows. Rows are the same as those of a `FeatureStore` converted
+    with the same settings, so changing `doc_stride` or `max_seq_length` does not
+    need any conversion.
+    """
+
+    def __init__(self, store, max_seq_length, doc_stride, max_query_length, max_n_answers):
+        self.store = store
+        self.max_seq_length = max_seq_length
+        self.max_n_answers = max_n_answers
+        self.cls_id, self.sep_id = store.meta['cls_id'], store.meta['sep_id']
+        c = store.columns
+        self.query_length = np.minimum(np.asarray(c['query_length']), max_query_length)
+        paragraph_example = np.asarray(c['paragraph_example'])
+        n_query = self.query_length[paragraph_example]
+        n_tokens = np.asarray(c['paragraph_length'])
+
+        # Same sliding windows as `_convert_example_to_features`: every window
+        # but the last has `max_tokens_for_doc` tokens (the -3 accounts for
+        # [CLS], [SEP] and [SEP]) and starts `stride` tokens after the previous one.
+        max_tokens_for_doc = max_seq_length - n_query - 3
+        stride = np.minimum(max_tokens_for_doc, doc_stride)
+        n_windows = np.where(n_tokens > 0,
+                             1 + np.maximum(0, -((max_tokens_for_doc - n_tokens) // stride)), 0)
+        self.window_paragraph = np.repeat(np.arange(len(n_tokens)), n_windows)
+        doc_span_index = np.arange(len(self.window_paragraph)) - \
+                (np.cumsum(n_windows) - n_windows)[self.window_paragraph]
+        self.doc_span_start = doc_span_index * stride[self.window_paragraph]
+        self.doc_span_length = np.minimum(n_tokens[self.window_paragraph] - self.doc_span_start,
+                                          max_tokens_for_doc[self.window_paragraph])
+        self.window_example = paragraph_example[self.window_paragraph]
+        self.seq_lengths = (n_query[self.window_paragraph] + 3 + self.doc_span_length).astype(np.int32)
+        self.positive_indices, self.negative_indices = self._partition_negatives()
+
+    @property
+    def n_groups(self):
+        return self.store.n_groups
+
+    def __len__(self):
+        return len(self.window_paragraph)
+
+    def _kept(self, answers, windows):
+        # Yes/no answers are kept in every window; the others only in the windows
+        # that contain them.
+        c = self.store.columns
+        start, end = np.asarray(c['answer_start'][answers]), np.asarray(c['answer_end'][answers])
+        doc_start = self.doc_span_start[windows]
+        doc_end = doc_start + self.doc_span_length[windows] - 1
+        return np.asarray(c['answer_yes_no'][answers]) | \
+                ((start >= doc_start) & (end >= doc_start) & (start <= doc_end) & (end <= doc_end))
+
+    def _partition_negatives(self):
+        """Same partition as `partition_negatives` on the built rows, computed on
+        all (window, answer) pairs at once."""
+        n_answers = np.asarray(self.store.columns['n_answers'])[self.window_paragraph]
+        first_pair = np.cumsum(n_answers) - n_answers
+        pair_window = np.repeat(np.arange(len(self)), n_answers)
+        answers = self.store.answer_offsets[self.window_paragraph][pair_window] + \
+                np.arange(len(pair_window)) - first_pair[pair_window]
+        kept = self._kept(answers, pair_window)
+        # Rank of each kept answer among those of its window: only the first
+        # `max_n_answers` of them are unmasked.
+        n_kept = np.concatenate([[0], np.cumsum(kept)])
+        rank = n_kept[1:] - 1 - n_kept[first_pair][pair_window]
+        switch = np.asarray(self.store.columns['answer_switch'])[answers]
+        negative = np.bincount(pair_window[kept & (rank < self.max_n_answers) & (switch == 3)],
+                               minlength=len(self)) > 0
+        # Windows without any answer get a single switch-3 answer.
+        negative |= np.bincount(pair_window[kept], minlength=len(self)) == 0
+        return np.flatnonzero(~negative), np.flatnonzero(negative)
+
+    def row(self, index):
+        """`input_ids`, `input_mask`, `segment_ids`, `start_position`,
+        `end_position` and `switch` of the `index`-th window (answers are not
+        padded)."""
+        c, store = self.store.columns, self.store
+        paragraph, example = self.window_paragraph[index], self.window_example[index]
+        doc_start, length = int(self.doc_span_start[index]), int(self.doc_span_length[index])
+        n_query = int(self.query_length[example])
+        query_start = store.query_offsets[example]
+        paragraph_start = store.paragraph_offsets[paragraph] + doc_start
+
+        # Window layout: [CLS] question [SEP] document span [SEP]
+        doc_offset = n_query + 2
+        n_tokens = doc_offset + length + 1
+        input_ids = np.zeros(self.max_seq_length, dtype=c['paragraph_ids'].dtype)
+        input_ids[0] = self.cls_id
+        input_ids[1:doc_offset-1] = c['query_ids'][query_start:query_start+n_query]
+        input_ids[doc_offset-1] = self.sep_id
+        input_ids[doc_offset:n_tokens-1] = c['paragraph_ids'][paragraph_start:paragraph_start+length]
+        input_ids[n_tokens-1] = self.sep_id
+        input_mask = np.zeros(self.max_seq_length, dtype=FIXED_COLUMNS['input_mask'])
+        input_mask[:n_tokens] = 1
+        segment_ids = np.zeros(self.max_seq_length, dtype=FIXED_COLUMNS['segment_ids'])
+        segment_ids[doc_offset:n_tokens] = 1
+
+        answers = np.arange(store.answer_offsets[paragraph], store.answer_offsets[paragraph+1])
+        kept = answers[self._kept(answers, index)][:self.max_n_answers]
+        start_position = np.where(c['answer_yes_no'][kept], 0,
+                                  c['answer_start'][kept] - doc_start + doc_offset)
+        end_position = np.where(c['answer_yes_no'][kept], 0,
+                                c['answer_end'][kept] - doc_start + doc_offset)
+        switch = c['answer_switch'][kept]
+        if len(kept) == 0:
+            start_position, end_position, switch = [0], [0], [3]
+        answers = [np.asarray(values, dtype=ANSWER_COLUMNS[key]) for (key, values) in
+                   zip(['start_position', 'end_position', 'switch'], [start_position, end_position, switch])]
+        return [input_ids, input_mask, segment_ids] + answers
+
+
+def partition_negatives(switches, answer_offsets):
+    """Returns the indices of the positive features and of the negative ones (a
+    feature is negative if one of its answers has switch 3, i.e. the window
+    contains no answer). Answers are flat, addressed through `answer_offsets`."""
+    n_no_answer = np.concatenate([[0], np.cumsum(np.asarray(switches) == 3)])
+    negative = np.diff(n_no_answer[np.asarray(answer_offsets)]) > 0
+    return np.flatnonzero(~negative), np.flatnonzero(negative)
+
+
+def example_hash(example):
+    """Hash of the fields of a `SquadExample` that feature conversion depends on."""
+    content = [example.question_text, example.doc_tokens, example.paragraph_indices,
+               example.orig_answer_text, example.start_position, example.end_position,
+               example.switch]
+    return hashlib.sha1(json.dumps(content).encode('utf-8')).hexdigest().encode('ascii')
+
+
+def file_hash(input_file):
+    """Hash of the contents of the (comma-separated) input files."""
+    sha1 = hashlib.sha1()
+    for _input_file in input_file.split(','):
+        with open(_input_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(chunk)
+        sha1.update(b'\0')
+    return sha1.hexdigest()
+
+
+def file_stat(input_file):
+    """Size and modification time of each of the (comma-separated) input files."""
+    stats = []
+    for _input_file in input_file.split(','):
+        stat = os.stat(_input_file)
+        stats.append([stat.st_size, stat.st_mtime_ns])
+    return stats
+
+
+def input_unchanged(path, meta, input_file, input_stat):
+    """Whether the store saved at `path`, with `meta`, was computed from the
+    current contents of `input_file`, whose `file_stat` is `input_stat`.
+
+    Input files are only hashed when their size or modification time differ from
+    the saved ones. If their contents turn out to be the same, the new
+    `input_stat` is saved so that they are not hashed again.
+    """
+    if meta.get('input_stat') == input_stat:
+        return True
+    if meta.get('input_hash') != file_hash(input_file):
+        return False
+    meta_path = os.path.join(path, 'meta.json')
+    with open(meta_path, 'r') as f:
+        saved_meta = json.load(f)
+    saved_meta['input_stat'] = input_stat
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump(saved_meta, f)
+    os.replace(meta_path + '.tmp', meta_path)
+    meta['input_stat'] = input_stat
+    return True
+
+
+class _ColumnWriter(object):
+    """Appends arrays to raw column files under `path + '.tmp'`; `_finish` turns
+    them into `.npy` files and renames the directory to `path`, so an interrupted
+    run never leaves a partial store behind."""
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.shapes = {}
+        self.dtypes = {}
+        if os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+
+    def append_column(self, key, array):
+        array = np.ascontiguousarray(array)
+        if key in self.shapes:
+            assert self.dtypes[key] == array.dtype and self.shapes[key][1:] == array.shape[1:]
+            self.shapes[key] = (self.shapes[key][0] + array.shape[0],) + array.shape[1:]
+        else:
+            self.shapes[key] = array.shape
+            self.dtypes[key] = array.dtype
+        with open(os.path.join(self.tmp_path, key + '.bin'), 'ab') as f:
+            array.tofile(f)
+
+    def _finish_columns(self):
+        for key in self.shapes:
+            raw_path = os.path.join(self.tmp_path, key + '.bin')
+            with open(os.path.join(self.tmp_path, key + '.npy'), 'wb') as f:
+                np.lib.format.write_array_header_1_0(f, {
+                    'descr': np.lib.format.dtype_to_descr(self.dtypes[key]),
+                    'fortran_order': False,
+                    'shape': self.shapes[key]})
+                with open(raw_path, 'rb') as raw:
+                    shutil.copyfileobj(raw, f)
+            os.remove(raw_path)
+
+    def _finish(self, meta):
+        with open(os.path.join(self.tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.rename(self.tmp_path, self.path)
+
+
+class FeatureStoreWriter(_ColumnWriter):
+    """Writes a `FeatureStore` to disk incrementally, one example's features at a
+    time, so that features never need to be held in memory all together.
+
+    Rows are buffered and appended to raw column files, which `close` turns into
+    `.npy` files. Everything is written to `path + '.tmp'` and renamed at the
+    end, so an interrupted run never leaves a partial store behind.
+    """
+
+    def __init__(self, path, is_training, max_seq_length=None, max_n_answers=None,
+                 buffer_size=4096, vocab_size=None):
+        super(FeatureStoreWriter, self).__init__(path)
+        self.is_training = is_training
+        self.max_seq_length = max_seq_length
+        self.max_n_answers = max_n_answers
+        self.ids_dtype = ids_dtype(vocab_size)
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.group_sizes = []
+        self.n_tokens = []
+        self.n_answers = []
+
+    def add(self, features):
+        """Appends the features of one example."""
+        self.group_sizes.append(len(features))
+        self.buffer += features
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        columns, n_tokens, n_answers = _columns_from_features(self.buffer, self.max_seq_length,
+                                                              self.max_n_answers, self.is_training,
+                                                              self.ids_dtype)
+        for key, array in columns.items():
+            self.append_column(key, array)
+        self.n_tokens += n_tokens
+        self.n_answers += n_answers
+        self.buffer = []
+
+    def close(self, examples=None, example_hashes=None, **meta):
+        """Finalizes the store. `example_hashes` (see `FeatureCache`) and any
+        extra `meta` entries are saved alongside the columns."""
+        self.flush()
+        self._finish_columns()
+        offsets_key, lengths = ('answer_offsets', self.n_answers) if self.is_training else \
+                ('token_offsets', self.n_tokens)
+        np.save(os.path.join(self.tmp_path, offsets_key + '.npy'),
+                np.cumsum([0] + lengths).astype(np.int64))
+        columns = sorted(list(self.shapes) + [offsets_key])
+        np.save(os.path.join(self.tmp_path, 'group_offsets.npy'),
+                np.cumsum([0] + self.group_sizes).astype(np.int64))
+        if self.is_training:
+            positive_indices, negative_indices = partition_negatives(
+                np.load(os.path.join(self.tmp_path, 'switch.npy'), mmap_mode='r'),
+                np.load(os.path.join(self.tmp_path, 'answer_offsets.npy')))
+            np.save(os.path.join(self.tmp_path, 'positive_indices.npy'), positive_indices)
+            np.save(os.path.join(self.tmp_path, 'negative_indices.npy'), negative_indices)
+        if examples is not None:
+            with open(os.path.join(self.tmp_path, 'examples.pkl'), 'wb') as f:
+                pkl.dump(examples, f)
+        if example_hashes is not None:
+            np.save(os.path.join(self.tmp_path, 'example_hashes.npy'),
+                    np.array(example_hashes, dtype='S40'))
+        meta.update({'is_training': self.is_training,
+                     'n_features': int(sum(self.group_sizes)),
+                     'columns': columns})
+        self._finish(meta)
+
+
+class ParagraphStoreWriter(_ColumnWriter):
+    """Writes a `ParagraphStore` to disk incrementally, one example at a time."""
+
+    def __init__(self, path, buffer_size=4096, vocab_size=None):
+        super(ParagraphStoreWriter, self).__init__(path)
+        self.ids_dtype = ids_dtype(vocab_size)
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.n_examples = 0
+
+    def add(self, query_ids, paragraphs):
+        """Appends one example: the ids of its question and, for each of its
+        paragraphs, a tuple `(paragraph_index, paragraph_ids, answer_starts,
+        answer_ends, answer_switches, answer_yes_no)` (answer positions are token
+        indices in the paragraph)."""
+        self.buffer.append((query_ids, paragraphs))
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        for key, array in _paragraph_columns(self.buffer, self.n_examples, self.ids_dtype).items():
+            self.append_column(key, array)
+        self.n_examples += len(self.buffer)
+        self.buffer = []
+
+    def close(self, **meta):
+        """Finalizes the store; `meta` must include the `cls_id` and `sep_id` of
+        the vocab."""
+        self.flush()
+        self._finish_columns()
+        meta.update({'n_examples': self.n_examples, 'columns': sorted(self.shapes)})
+        self._finish(meta)
+
+
+def ids_dtype(vocab_size=None):
+    """The narrowest dtype holding the token ids of a vocab of `vocab_size` tokens."""
+    if vocab_size is not None and vocab_size <= np.iinfo(np.int16).max + 1:
+        return np.int16
+    return FIXED_COLUMNS['input_ids']
+
+
+def _columns_from_features(flat, max_seq_length, max_n_answers, is_training,
+                           input_ids_dtype=FIXED_COLUMNS['input_ids']):
+    """Converts a flat list of `InputFeatures` into column arrays, filling
+    preallocated arrays row by row. Also returns the number of tokens of each
+    feature (empty when `is_training`) and its number of answers (empty unless
+    `is_training`)."""
+    assert max_seq_length <= np.iinfo(ANSWER_COLUMNS['start_position']).max
+    columns = {}
+    for key in ['unique_id', 'example_index', 'paragraph_index', 'doc_span_index']:
+        columns[key] = np.fromiter((getattr(f, key) for f in flat), dtype=FIXED_COLUMNS[key],
+                                   count=len(flat))
+    columns['seq_length'] = np.fromiter((f.input_mask.sum() for f in flat), dtype=np.int32,
+                                        count=len(flat))
+    dtypes = dict(FIXED_COLUMNS, input_ids=input_ids_dtype)
+    for key in ['input_ids', 'input_mask', 'segment_ids']:
+        columns[key] = np.empty((len(flat), max_seq_length), dtype=dtypes[key])
+        for (i, f) in enumerate(flat):
+            columns[key][i] = getattr(f, key)
+    n_tokens, n_answers = [], []
+    if is_training:
+        # Masked answers are always after the unmasked ones.
+        n_answers = [int(f.answer_mask.sum()) for f in flat]
+        for key in ANSWER_COLUMNS:
+            columns[key] = np.concatenate(
+                [getattr(f, key)[:n] for (f, n) in zip(flat, n_answers)] or [[]]
+                ).astype(ANSWER_COLUMNS[key])
+    else:
+        n_tokens = [f.num_tokens for f in flat]
+        columns['tok_to_orig'] = np.concatenate(
+            [f.token_to_orig_map for f in flat] or [[]]).astype(RAGGED_COLUMNS['tok_to_orig'])
+        columns['max_context'] = np.concatenate(
+            [np.unpackbits(f.token_is_max_context, count=f.num_tokens) for f in flat] or [[]]
+            ).astype(RAGGED_COLUMNS['max_context'])
+    return columns, n_tokens, n_answers
+
+
+def _offsets(lengths):
+    return np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+
+def _paragraph_columns(items, first_example_index, input_ids_dtype=PARAGRAPH_COLUMNS['query_ids']):
+    """Converts `(query_ids, paragraphs)` pairs (see `ParagraphStoreWriter.add`)
+    of consecutive examples into the columns of a `ParagraphStore`."""
+    paragraphs = [(example_index, paragraph) for (example_index, (_, _paragraphs))
+                  in enumerate(items, first_example_index) for paragraph in _paragraphs]
+    dtypes = dict(PARAGRAPH_COLUMNS, query_ids=input_ids_dtype, paragraph_ids=input_ids_dtype)
+    values = {
+        'query_length': [len(query_ids) for (query_ids, _) in items],
+        'query_ids': [i for (query_ids, _) in items for i in query_ids],
+        'paragraph_example': [example_index for (example_index, _) in paragraphs],
+        'paragraph_index': [p[0] for (_, p) in paragraphs],
+        'paragraph_length': [len(p[1]) for (_, p) in paragraphs],
+        'n_answers': [len(p[2]) for (_, p) in paragraphs],
+    }
+    for (i, key) in enumerate(['paragraph_ids', 'answer_start', 'answer_end', 'answer_switch',
+                               'answer_yes_no'], 1):
+        values[key] = [v for (_, p) in paragraphs for v in p[i]]
+    return {key: np.array(values[key], dtype=dtypes[key]) for key in PARAGRAPH_COLUMNS}
@@ -38,7 +38,7 @@ import tokenization
 from modeling import BertConfig, BertForQuestionAnswering
 from optimization import BERTAdam
 
-from prepro import get_dataloader
+from prepro import get_dataloader, get_streaming_dataloader, ShardPrefetcher
 from evaluate_qa import write_predictions
 
 RawResult = collections.namedtuple("RawResult",
@@ -110,6 +110,42 @@ def main():
     parser.add_argument('--n_paragraphs', type=str, default='40')
     parser.add_argument('--verbose', action="store_true", default=False)
     parser.add_argument('--wait_step', type=int, default=12)
+    parser.add_argument('--num_prepro_workers', type=int, default=1,
+                        help="Number of processes used to convert examples into features.")
+    parser.add_argument('--dynamic_padding', action="store_true", default=False,
+                        help="Batch features of similar length together and pad each batch only to its "
+                             "longest sequence. Since the switch classifier max-pools over all positions, "
+                             "this slightly changes the model compared to padding to max_seq_length.")
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help="Number of DataLoader worker processes (0 loads batches in the main process).")
+    parser.add_argument('--prefetch_factor', type=int, default=2,
+                        help="Number of batches loaded in advance by each DataLoader worker.")
+    parser.add_argument('--persistent_workers', action="store_true", default=False,
+                        help="Keep DataLoader workers alive between epochs and evaluations.")
+    parser.add_argument('--streaming', action="store_true", default=False,
+                        help="Stream training features from all --train_file files in every epoch, "
+                             "reading them from disk instead of loading one file per epoch.")
+    parser.add_argument('--shuffle_buffer', type=int, default=10000,
+                        help="Number of features in the shuffle buffer of --streaming.")
+    parser.add_argument('--lazy_windows', action="store_true", default=False,
+                        help="Save only the question and paragraph WordPiece ids of the training data and "
+                             "build each window when it is loaded; the saved data is reused for any "
+                             "--max_seq_length, --doc_stride, --max_query_length and --max_n_answers.")
+    parser.add_argument('--prefetch_shards', type=int, default=1,
+                        help="With several --train_file, number of upcoming files loaded on a background "
+                             "thread during training (0 loads each file when its epoch starts).")
+    parser.add_argument('--attention_backend', type=str, default=None, choices=["eager", "sdpa"],
+                        help="Overrides `attention_backend` of the BERT config: `sdpa` uses the fused "
+                             "scaled_dot_product_attention kernels, `eager` (the default) the exact "
+                             "original computation.")
+    parser.add_argument('--fused_ops', action="store_true", default=False,
+                        help="Use PyTorch's native LayerNorm and gelu kernels (sets `fused_ops` of the "
+                             "BERT config); checkpoints are compatible either way.")
+    parser.add_argument('--wordpiece_cache_size', type=int, default=100000,
+                        help="Max number of words whose WordPiece tokenization is memoized (0 to disable).")
+    parser.add_argument('--wordpiece_cache_policy', type=str, default="lru", choices=["lru", "fifo"])
+    parser.add_argument('--wordpiece_cache_file', type=str, default=None,
+                        help="If given, the WordPiece cache is loaded from and saved to this file.")
 
     # Learning method variation
     parser.add_argument('--loss_type', type=str, default="mml")
@@ -167,6 +203,8 @@ def main():
         if not args.predict_file:
             raise ValueError(
                 "If `do_train` is True, then `predict_file` must be specified.")
+        if args.lazy_windows and args.streaming:
+            raise ValueError("`lazy_windows` can not be combined with `streaming`.")
 
     if args.do_predict:
         if not args.predict_file:
@@ -174,6 +212,10 @@ def main():
                 "If `do_predict` is True, then `predict_file` must be specified.")
 
     bert_config = BertConfig.from_json_file(args.bert_config_file)
+    if args.attention_backend is not None:
+        bert_config.attention_backend = args.attention_backend
+    if args.fused_ops:
+        bert_config.fused_ops = True
 
     if args.do_train and args.max_seq_length > bert_config.max_position_embeddings:
         raise ValueError(
@@ -187,23 +229,48 @@ def main():
 
 
     tokenizer = tokenization.FullTokenizer(
-        vocab_file=args.vocab_file, do_lower_case=args.do_lower_case)
+        vocab_file=args.vocab_file, do_lower_case=args.do_lower_case,
+        cache_size=args.wordpiece_cache_size, cache_policy=args.wordpiece_cache_policy)
+    wordpiece_cache = tokenizer.wordpiece_tokenizer.cache
+    if args.wordpiece_cache_file is not None and os.path.exists(args.wordpiece_cache_file):
+        if wordpiece_cache.load(args.wordpiece_cache_file, tokenizer.vocab):
+            logger.info("Loaded %d WordPiece cache entries from %s" % (
+                len(wordpiece_cache), args.wordpiece_cache_file))
+        else:
+            logger.info("Ignoring %s: it was built with a different vocab" % args.wordpiece_cache_file)
 
     train_examples = None
     num_train_steps = None
-    train_split = ',' in args.train_file
+    # With `--streaming`, every epoch streams through all the training files instead.
+    train_split = ',' in args.train_file and not args.streaming
     if train_split:
         n_train_files = len(args.train_file.split(','))
 
+    # Evaluation during training scores every paragraph. Prediction that scores
+    # each of `n_paragraphs` never uses paragraphs beyond the largest one, so
+    # only their features are served.
+    varying_n_paragraphs = len(args.n_paragraphs)>1
+    eval_n_paragraphs = None
+    if not args.do_train and varying_n_paragraphs:
+        eval_n_paragraphs = max(int(n) for n in args.n_paragraphs.split(','))
+
     eval_dataloader, eval_examples, eval_features, _ = get_dataloader(
                 logger=logger, args=args,
                 input_file=args.predict_file,
                 is_training=False,
                 batch_size=args.predict_batch_size,
                 num_epochs=1,
-                tokenizer=tokenizer)
+                tokenizer=tokenizer,
+                n_paragraphs=eval_n_paragraphs)
 
-    if args.do_train:
+    if args.do_train and args.streaming:
+        train_dataloader, num_train_steps = get_streaming_dataloader(
+                logger=logger, args=args,
+                input_files=args.train_file,
+                batch_size=args.train_batch_size,
+                num_epochs=args.num_train_epochs,
+                tokenizer=tokenizer)
+    elif args.do_train:
         train_file = args.train_file
         if train_split:
             train_file = args.train_file.split(',')[0]
@@ -215,6 +282,9 @@ def main():
                 num_epochs=args.num_train_epochs,
                 tokenizer=tokenizer)
 
+    if args.wordpiece_cache_file is not None:
+        wordpiece_cache.save(args.wordpiece_cache_file, tokenizer.vocab)
+
     if args.init_checkpoint is not None:
         logger.info("Loading from {}".format(args.init_checkpoint))
         state_dict = torch.load(args.init_checkpoint, map_location='cpu')
@@ -253,20 +323,33 @@ def main():
         stop_training = False
         train_losses = []
 
+        load_train_dataloader = lambda train_file: get_dataloader(
+                logger=logger, args=args, \
+                input_file=train_file, \
+                is_training=True,
+                batch_size=args.train_batch_size,
+                num_epochs=args.num_train_epochs,
+                tokenizer=tokenizer)[0]
+        prefetcher = None
+        if train_split and args.prefetch_shards > 0:
+            prefetcher = ShardPrefetcher(
+                    logger, load_train_dataloader,
+                    [args.train_file.split(',')[epoch%n_train_files] \
+                     for epoch in range(1, int(args.num_train_epochs))],
+                    max_prefetch=args.prefetch_shards)
+
         for epoch in range(int(args.num_train_epochs)):
             if epoch>0 and train_split:
-                train_file = args.train_file.split(',')[epoch%n_train_files]
-                train_dataloader = get_dataloader(
-                        logger=logger, args=args, \
-                        input_file=train_file, \
-                        is_training=True,
-                        batch_size=args.train_batch_size,
-                        num_epochs=args.num_train_epochs,
-                        tokenizer=tokenizer)[0]
+                if prefetcher is not None:
+                    train_dataloader = prefetcher.next()
+                else:
+                    train_dataloader = load_train_dataloader(args.train_file.split(',')[epoch%n_train_files])
+            train_dataloader.set_epoch(epoch)
 
             for step, batch in enumerate(train_dataloader):
                 global_step += 1
-                batch = [t.to(device) for t in batch]
+                # Batches hold narrow dtypes; they are widened after the transfer.
+                batch = [t.to(device).long() for t in batch]
                 loss = model(batch, global_step)
                 if n_gpu > 1:
                     loss = loss.mean() # mean() to average on multi-gpu.
@@ -301,6 +384,8 @@ def main():
             if stop_training:
                 break
 
+        if prefetcher is not None:
+            prefetcher.close()
         logger.info("Training finished!")
 
     elif args.do_predict:
@@ -310,7 +395,7 @@ def main():
             model.eval()
         f1 = predict(logger, args, model, eval_dataloader, eval_examples, eval_features,
                      device,
-                     varying_n_paragraphs=len(args.n_paragraphs)>1)
+                     varying_n_paragraphs=varying_n_paragraphs)
 
 
 def predict(logger, args, model, eval_dataloader, eval_examples, eval_features, device, \
@@ -320,9 +405,12 @@ def predict(logger, args, model, eval_dataloader, eval_examples, eval_features,
     if args.verbose:
         eval_dataloader = tqdm(eval_dataloader)
 
+    # Only the unique ids of the features are needed here, so they are read
+    # from the store without building the features.
+    unique_ids = np.asarray(eval_features.columns['unique_id'])
     for batch in eval_dataloader:
         example_indices = batch[-1]
-        batch_to_feed = [t.to(device) for t in batch[:-1]]
+        batch_to_feed = [t.to(device).long() for t in batch[:-1]]
         with torch.no_grad():
             batch_start_logits, batch_end_logits, batch_switch = model(batch_to_feed)
             assert len(batch_start_logits)==len(batch_end_logits)==len(batch_switch)
@@ -330,8 +418,7 @@ def predict(logger, args, model, eval_dataloader, eval_examples, eval_features,
             start_logits = batch_start_logits[i].detach().cpu().tolist()
             end_logits = batch_end_logits[i].detach().cpu().tolist()
             switch = batch_switch[i].detach().cpu().tolist()
-            eval_feature = eval_features[example_index.item()]
-            unique_id = int(eval_feature.unique_id)
+            unique_id = int(unique_ids[example_index.item()])
             all_results.append(RawResult(unique_id=unique_id,
                                         start_logits=start_logits,
                                         end_logits=end_logits,
@@ -25,7 +25,7 @@ import six
 import torch
 import  numpy
 import torch.nn as nn
-from torch.nn import CrossEntropyLoss
+import torch.nn.functional as F
 
 def gelu(x):
     """Implementation of the gelu activation function.
@@ -49,7 +49,9 @@ class BertConfig(object):
                 attention_probs_dropout_prob=0.1,
                 max_position_embeddings=512,
                 type_vocab_size=16,
-                initializer_range=0.02):
+                initializer_range=0.02,
+                attention_backend="eager",
+                fused_ops=False):
         """Constructs BertConfig.
 
         Args:
@@ -73,6 +75,14 @@ class BertConfig(object):
                 `BertModel`.
             initializer_range: The sttdev of the truncated_normal_initializer for
                 initializing all weight matrices.
+            attention_backend: "eager" computes self-attention op by op, "sdpa" with
+                `torch.nn.functional.scaled_dot_product_attention` (fused kernels,
+                without materializing the attention probabilities where supported).
+                Both give the same results up to float rounding (and the random
+                dropout mask); "eager" reproduces earlier runs exactly.
+            fused_ops: Whether LayerNorm and the gelu activation use PyTorch's
+                native `F.layer_norm` and `F.gelu` kernels instead of being computed
+                op by op. Parameters (and so checkpoints) are the same either way.
         """
         self.vocab_size = vocab_size
         self.hidden_size = hidden_size
@@ -85,6 +95,8 @@ class BertConfig(object):
         self.max_position_embeddings = max_position_embeddings
         self.type_vocab_size = type_vocab_size
         self.initializer_range = initializer_range
+        self.attention_backend = attention_backend
+        self.fused_ops = fused_ops
 
     @classmethod
     def from_dict(cls, json_object):
@@ -126,6 +138,18 @@ class BERTLayerNorm(nn.Module):
         x = (x - u) / torch.sqrt(s + self.variance_epsilon)
         return self.gamma * x + self.beta
 
+class FusedBERTLayerNorm(BERTLayerNorm):
+    """`BERTLayerNorm` computed by `F.layer_norm`, which also normalizes with the
+    biased variance and the epsilon inside the square root. Parameters keep the
+    `gamma`/`beta` names, so checkpoints load into either module."""
+
+    def forward(self, x):
+        return F.layer_norm(x, self.gamma.shape, self.gamma, self.beta, self.variance_epsilon)
+
+def layer_norm(config):
+    """The LayerNorm module selected by `config.fused_ops`."""
+    return FusedBERTLayerNorm(config) if config.fused_ops else BERTLayerNorm(config)
+
 class BERTEmbeddings(nn.Module):
     def __init__(self, config):
         super(BERTEmbeddings, self).__init__()
@@ -135,7 +159,7 @@ class BERTEmbeddings(nn.Module):
         self.position_embeddings = nn.Embedding(config.max_position_embeddings, config.hidden_size)
         self.token_type_embeddings = nn.Embedding(config.type_vocab_size, config.hidden_size)
 
-        self.LayerNorm = BERTLayerNorm(config)
+        self.LayerNorm = layer_norm(config)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
     def forward(self, input_ids, token_type_ids=None):
@@ -171,6 +195,9 @@ class BERTSelfAttention(nn.Module):
         self.value = nn.Linear(config.hidden_size, self.all_head_size)
 
         self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
+        if config.attention_backend not in ["eager", "sdpa"]:
+            raise ValueError("Unknown attention backend: %s" % config.attention_backend)
+        self.attention_backend = config.attention_backend
 
     def transpose_for_scores(self, x):
         new_x_shape = x.size()[:-1] + (self.num_attention_heads, self.attention_head_size)
@@ -186,6 +213,14 @@ class BERTSelfAttention(nn.Module):
         key_layer = self.transpose_for_scores(mixed_key_layer)
         value_layer = self.transpose_for_scores(mixed_value_layer)
 
+        if self.attention_backend == "sdpa":
+            # Same computation as below in one fused op; `attention_mask` is the
+            # additive mask, broadcast over heads and query positions.
+            context_layer = F.scaled_dot_product_attention(
+                query_layer, key_layer, value_layer, attn_mask=attention_mask,
+                dropout_p=self.dropout.p if self.training else 0.0)
+            return self._merge_heads(context_layer)
+
         # Take the dot product between "query" and "key" to get the raw attention scores.
         attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
         attention_scores = attention_scores / math.sqrt(self.attention_head_size)
@@ -200,6 +235,9 @@ class BERTSelfAttention(nn.Module):
         attention_probs = self.dropout(attention_probs)
 
         context_layer = torch.matmul(attention_probs, value_layer)
+        return self._merge_heads(context_layer)
+
+    def _merge_heads(self, context_layer):
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
         context_layer = context_layer.view(*new_context_layer_shape)
@@ -210,7 +248,7 @@ class BERTSelfOutput(nn.Module):
     def __init__(self, config):
         super(BERTSelfOutput, self).__init__()
         self.dense = nn.Linear(config.hidden_size, config.hidden_size)
-        self.LayerNorm = BERTLayerNorm(config)
+        self.LayerNorm = layer_norm(config)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
     def forward(self, hidden_states, input_tensor):
@@ -236,7 +274,7 @@ class BERTIntermediate(nn.Module):
     def __init__(self, config):
         super(BERTIntermediate, self).__init__()
         self.dense = nn.Linear(config.hidden_size, config.intermediate_size)
-        self.intermediate_act_fn = gelu
+        self.intermediate_act_fn = F.gelu if config.fused_ops else gelu
 
     def forward(self, hidden_states):
         hidden_states = self.dense(hidden_states)
@@ -248,7 +286,7 @@ class BERTOutput(nn.Module):
     def __init__(self, config):
         super(BERTOutput, self).__init__()
         self.dense = nn.Linear(config.intermediate_size, config.hidden_size)
-        self.LayerNorm = BERTLayerNorm(config)
+        self.LayerNorm = layer_norm(config)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
     def forward(self, hidden_states, input_tensor):
@@ -392,6 +430,8 @@ class BertForQuestionAnswering(nn.Module):
             -      end_positions: [[7, 7, 0]]
             -      switch: [[0, 0, 0]]
             -      answer_mask: [[1, 1, 0]]
+        answers may also be padded only to the largest number of answers in the batch
+        (see `DataLoader.collate_features`) instead of `max_n_answers`.
         '''
 
         input_ids, attention_mask, token_type_ids = batch[:3]
@@ -407,54 +447,53 @@ class BertForQuestionAnswering(nn.Module):
     def forward(self, batch, global_step=-1):
         start_logits, end_logits, switch_logits = self._forward(batch)
         if len(batch) == 7:
-            start_positions, end_positions, switch, answer_mask = batch[3:]
-            ignored_index = start_logits.size(1)
-            start_positions.clamp_(0, ignored_index)
-            end_positions.clamp_(0, ignored_index)
-            answer_mask = answer_mask.type(torch.FloatTensor).to(self.device)
-            loss_fct = CrossEntropyLoss(ignore_index=ignored_index, reduce=False)
-            # You care about the span only when switch is 0
-            span_mask = answer_mask * (switch == 0).type(torch.FloatTensor).to(self.device)
-
-
-            start_losses = [(loss_fct(start_logits, _start_positions) * _span_mask) \
-                            for (_start_positions, _span_mask) \
-                            in zip(torch.unbind(start_positions, dim=1), torch.unbind(span_mask, dim=1))]
-            end_losses = [(loss_fct(end_logits, _end_positions) * _span_mask) \
-                            for (_end_positions, _span_mask) \
-                          in zip(torch.unbind(end_positions, dim=1), torch.unbind(span_mask, dim=1))]
-            switch_losses = [(loss_fct(switch_logits, _switch) * _answer_mask) \
-                            for (_switch, _answer_mask) \
-                            in zip(torch.unbind(switch, dim=1), torch.unbind(answer_mask, dim=1))]
-            assert len(start_losses) == len(end_losses) == len(switch_losses)
-            loss_tensor = \
-                        torch.cat([t.unsqueeze(1) for t in start_losses], dim=1) + \
-                        torch.cat([t.unsqueeze(1) for t in end_losses], dim=1) + \
-                        torch.cat([t.unsqueeze(1) for t in switch_losses], dim=1)
-
-            if self.loss_type=='first-only':
-                total_loss = torch.sum(start_losses[0]+end_losses[0]+switch_losses[0])
-            elif self.loss_type == "hard-em":
-                if numpy.random.random()<min(global_step/self.tau, 0.8):
-                    total_loss = self._take_min(loss_tensor)
-                else:
-                    total_loss = self._take_mml(loss_tensor)
-            elif self.loss_type == "mml":
-                total_loss = self._take_mml(loss_tensor)
-            else:
-                raise NotImplementedError()
-            return total_loss
-
+            return self.compute_loss(start_logits, end_logits, switch_logits, batch[3:], global_step)
         elif len(batch) == 3:
             return start_logits, end_logits, switch_logits
+        else:
+            raise NotImplementedError()
 
+    def compute_loss(self, start_logits, end_logits, switch_logits, answers, global_step=-1):
+        """Training objective for the (padded, see `_forward`) `answers` of a batch."""
+        loss_tensor, answer_mask = self._answer_losses(start_logits, end_logits, switch_logits, *answers)
+
+        if self.loss_type=='first-only':
+            total_loss = torch.sum(loss_tensor[:, 0])
+        elif self.loss_type == "hard-em":
+            if numpy.random.random()<min(global_step/self.tau, 0.8):
+                total_loss = self._take_min(loss_tensor, answer_mask)
+            else:
+                total_loss = self._take_mml(loss_tensor, answer_mask)
+        elif self.loss_type == "mml":
+            total_loss = self._take_mml(loss_tensor, answer_mask)
         else:
             raise NotImplementedError()
+        return total_loss
 
-    def _take_min(self, loss_tensor):
-        return torch.sum(torch.min(
-            loss_tensor + 2*torch.max(loss_tensor)*(loss_tensor==0).type(torch.FloatTensor).to(self.device), 1)[0])
+    def _answer_losses(self, start_logits, end_logits, switch_logits,
+                       start_positions, end_positions, switch, answer_mask):
+        """Loss of every answer slot, `[N, n_answers]`, and the mask of the real answers.
 
-    def _take_mml(self, loss_tensor):
-        return -torch.sum(torch.log(torch.sum(torch.exp(-loss_tensor - 1e10 * (loss_tensor==0).float()), 1)))
+        The loss of an answer is the cross entropy of its start and end (only
+        when its switch is 0) plus that of its switch. Log-probabilities are
+        computed once and gathered for all slots at once.
+        """
+        ignored_index = start_logits.size(1)
+        answer_mask = answer_mask.bool()
+        # You care about the span only when switch is 0
+        span_mask = answer_mask & (switch == 0)
+
+        span_positions = torch.stack([start_positions, end_positions], 1).clamp(0, ignored_index)
+        span_log_probs = F.log_softmax(torch.stack([start_logits, end_logits], 1), -1).gather(
+            2, span_positions.clamp(max=ignored_index - 1))
+        span_mask = span_mask.unsqueeze(1) & (span_positions != ignored_index)
+        span_losses = -span_log_probs.masked_fill(~span_mask, 0).sum(1)
+        switch_losses = -F.log_softmax(switch_logits, -1).gather(1, switch).masked_fill(~answer_mask, 0)
+        return span_losses + switch_losses, answer_mask
+
+    def _take_min(self, loss_tensor, answer_mask):
+        return torch.sum(torch.min(loss_tensor.masked_fill(~answer_mask, float('inf')), 1)[0])
+
+    def _take_mml(self, loss_tensor, answer_mask):
+        return -torch.sum(torch.logsumexp(-loss_tensor.masked_fill(~answer_mask, float('inf')), 1))
 
@@ -1,8 +1,13 @@
-import os
 import json
-import pickle as pkl
+import time
+import queue
+import bisect
+import hashlib
+import threading
 import tokenization
+import itertools
 import collections
+import multiprocessing
 from tqdm import tqdm
 
 import numpy as np
@@ -13,31 +18,102 @@ from torch.utils.data.distributed import DistributedSampler
 from tokenization import BasicTokenizer
 
 from prepro_util import *
-from DataLoader import MyDataLoader
+from DataLoader import MyDataLoader, StreamingDataLoader
+from feature_store import FeatureStore, FeatureStoreWriter, FeatureCache, file_hash, file_stat, \
+        input_unchanged, ParagraphStore, ParagraphStoreWriter, STORE_VERSION
 
 def get_dataloader(logger, args, input_file, is_training, \
-                   batch_size, num_epochs, tokenizer, index=None):
+                   batch_size, num_epochs, tokenizer, index=None, n_paragraphs=None):
 
-    n_paragraphs = args.n_paragraphs
+    if is_training and args.lazy_windows:
+        store, examples = get_lazy_windows(logger, args, input_file, tokenizer), None
+    else:
+        store, examples = get_feature_store(logger, args, input_file, is_training, tokenizer)
+    if n_paragraphs is not None:
+        store = store.first_paragraphs(n_paragraphs)
 
-    if (not is_training) and ',' in n_paragraphs:
-        n_paragraphs = n_paragraphs.split(',')[-1]
+    n_features = len(store)
+    num_train_steps = int(store.n_groups / batch_size * num_epochs)
 
-    feature_save_path = input_file.replace('.json', '-{}-{}-{}.pkl'.format(
-            args.max_seq_length, n_paragraphs, args.max_n_answers))
+    logger.info("  Num orig examples = %d", store.n_groups)
+    logger.info("  Num split examples = %d", n_features)
+    logger.info("  Batch size = %d", batch_size)
+    if is_training:
+        logger.info("  Num steps = %d", num_train_steps)
+
+    dataloader = MyDataLoader(store=store, batch_size=batch_size, is_training=is_training,
+                              dynamic_padding=args.dynamic_padding, seed=args.seed,
+                              num_workers=args.num_workers, prefetch_factor=args.prefetch_factor,
+                              persistent_workers=args.persistent_workers)
+    return dataloader, examples, store, num_train_steps
 
-    if os.path.exists(feature_save_path):
-        logger.info("Loading saved features from {}".format(feature_save_path))
-        with open(feature_save_path, 'rb') as f:
-            features = pkl.load(f)
-            train_features = features['features']
-            examples = features.get('examples', None)
-    else:
 
-        examples = read_squad_examples(
+def get_streaming_dataloader(logger, args, input_files, batch_size, num_epochs, tokenizer):
+    """Returns a `StreamingDataLoader` over the training features of all the
+    (comma-separated) `input_files`, and the number of training steps."""
+    stores = [get_feature_store(logger, args, input_file, True, tokenizer)[0] \
+              for input_file in input_files.split(',')]
+    n_groups = sum(store.n_groups for store in stores)
+    num_train_steps = int(n_groups / batch_size * num_epochs)
+
+    logger.info("  Num shards = %d", len(stores))
+    logger.info("  Num orig examples = %d", n_groups)
+    logger.info("  Num split examples = %d", sum(len(store) for store in stores))
+    logger.info("  Batch size = %d", batch_size)
+    logger.info("  Num steps = %d", num_train_steps)
+
+    # Saved stores are opened again by each worker rather than sent to it.
+    shards = [store.path if store.path is not None else store for store in stores]
+    dataloader = StreamingDataLoader(shards, batch_size=batch_size,
+                                     shuffle_buffer=args.shuffle_buffer,
+                                     dynamic_padding=args.dynamic_padding, seed=args.seed,
+                                     num_workers=args.num_workers,
+                                     prefetch_factor=args.prefetch_factor)
+    return dataloader, num_train_steps
+
+
+def get_feature_store(logger, args, input_file, is_training, tokenizer):
+    """Loads the `FeatureStore` of `input_file`, converting (and saving) the
+    features that are not saved yet. Returns the store and, for evaluation, the
+    examples."""
+
+    # Features are converted for every paragraph in the input file, so the saved
+    # store does not depend on `n_paragraphs`: prediction with fewer paragraphs
+    # slices it (see `get_dataloader`) instead of converting again.
+    feature_save_path = input_file.replace('.json', '-{}-{}.features'.format(
+            args.max_seq_length, args.max_n_answers))
+
+    max_n_answers = args.max_n_answers if is_training else 1
+    fingerprint = _feature_fingerprint(args, tokenizer, max_n_answers, is_training)
+    # Taken before the input file is read, so that later edits are noticed.
+    input_stat = file_stat(input_file)
+
+    store, saved_store = None, None
+    if FeatureStore.exists(feature_save_path):
+        saved_store = FeatureStore.load(feature_save_path)
+        if saved_store.meta.get('fingerprint') != fingerprint:
+            logger.info("Saved features in {} were computed with a different vocab or "
+                        "settings, recomputing them".format(feature_save_path))
+            saved_store = None
+        elif input_unchanged(feature_save_path, saved_store.meta, input_file, input_stat):
+            logger.info("Loading saved features from {}".format(feature_save_path))
+            store = saved_store
+        else:
+            logger.info("{} changed, only converting new or edited examples".format(input_file))
+
+    if store is not None:
+        examples = store.examples
+    else:
+        # Examples are streamed from the input file through feature conversion.
+        # They are only kept around for evaluation, where `write_predictions`
+        # needs them.
+        examples = iter_squad_examples(
             logger=logger, args=args, input_file=input_file, debug=args.debug)
+        if not is_training:
+            examples = list(examples)
 
-        train_features = convert_examples_to_features(
+        cache = None if args.debug else FeatureCache(saved_store)
+        features = iter_features(
             logger=logger,
             args=args,
             examples=examples,
@@ -45,54 +121,186 @@ def get_dataloader(logger, args, input_file, is_training, \
             max_seq_length=args.max_seq_length,
             doc_stride=args.doc_stride,
             max_query_length=args.max_query_length,
-            max_n_answers=args.max_n_answers if is_training else 1,
-            is_training=is_training)
-        if not args.debug:
+            max_n_answers=max_n_answers,
+            is_training=is_training,
+            cache=cache)
+        if args.debug:
+            store = FeatureStore.from_features(list(features),
+                                               max_seq_length=args.max_seq_length,
+                                               max_n_answers=max_n_answers,
+                                               is_training=is_training,
+                                               examples=None if is_training else examples,
+                                               vocab_size=len(tokenizer.vocab))
+        else:
             logger.info("Saving features to: {}".format(feature_save_path))
-            save_features = {'features': train_features}
-            if not is_training:
-                save_features['examples'] = examples
-            with open(feature_save_path, 'wb') as f:
-                pkl.dump(save_features, f)
-
-    n_features = sum([len(f) for f in train_features])
-    num_train_steps = int(len(train_features) / batch_size * num_epochs)
-
-    if examples is not None:
-        logger.info("  Num orig examples = %d", len(examples))
-    logger.info("  Num split examples = %d", n_features)
-    logger.info("  Batch size = %d", batch_size)
-    if is_training:
-        logger.info("  Num steps = %d", num_train_steps)
-
-    dataloader = MyDataLoader(features=train_features, batch_size=batch_size, is_training=is_training)
-    flattened_features = [f for _features in train_features for f in _features]
-    return dataloader, examples, flattened_features, num_train_steps
-
+            writer = FeatureStoreWriter(feature_save_path, is_training,
+                                        max_seq_length=args.max_seq_length,
+                                        max_n_answers=max_n_answers,
+                                        vocab_size=len(tokenizer.vocab))
+            for current_features in features:
+                writer.add(current_features)
+            writer.close(examples=None if is_training else examples,
+                         example_hashes=cache.example_hashes,
+                         fingerprint=fingerprint,
+                         input_hash=file_hash(input_file),
+                         input_stat=input_stat)
+            logger.info("Reused saved features of %d/%d examples" % (
+                cache.n_hits, len(cache.example_hashes)))
+            store = FeatureStore.load(feature_save_path)
+        examples = store.examples
+        wordpiece_cache = tokenizer.wordpiece_tokenizer.cache
+        logger.info("WordPiece cache: %d words, hit rate %.1f%%" % (
+            len(wordpiece_cache), wordpiece_cache.hit_rate()*100))
+    store.id_to_token = tokenizer.convert_ids_to_tokens
+    return store, examples
+
+
+def get_lazy_windows(logger, args, input_file, tokenizer):
+    """Returns the `LazyWindows` of the training file `input_file`, converting
+    (and saving) its `ParagraphStore` if it is not saved yet.
+
+    The saved store only depends on the tokenizer, so it is reused for any
+    `max_seq_length`, `doc_stride`, `max_query_length` and `max_n_answers`."""
+
+    paragraph_save_path = input_file.replace('.json', '.paragraphs')
+    fingerprint = _paragraph_fingerprint(tokenizer)
+    input_stat = file_stat(input_file)
+
+    store = None
+    if ParagraphStore.exists(paragraph_save_path):
+        saved_store = ParagraphStore.load(paragraph_save_path)
+        if saved_store.meta.get('fingerprint') != fingerprint or \
+                not input_unchanged(paragraph_save_path, saved_store.meta, input_file, input_stat):
+            logger.info("Saved paragraphs in {} were computed from a different input file, "
+                        "vocab or settings, recomputing them".format(paragraph_save_path))
+        else:
+            logger.info("Loading saved paragraphs from {}".format(paragraph_save_path))
+            store = saved_store
+
+    if store is None:
+        examples = iter_squad_examples(
+            logger=logger, args=args, input_file=input_file, debug=args.debug)
+        paragraphs = iter_paragraphs(logger, args, examples, tokenizer)
+        cls_id, sep_id = tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+        if args.debug:
+            store = ParagraphStore.from_paragraphs(list(paragraphs), vocab_size=len(tokenizer.vocab),
+                                                   cls_id=cls_id, sep_id=sep_id)
+        else:
+            logger.info("Saving paragraphs to: {}".format(paragraph_save_path))
+            writer = ParagraphStoreWriter(paragraph_save_path, vocab_size=len(tokenizer.vocab))
+            for (query_ids, current_paragraphs) in paragraphs:
+                writer.add(query_ids, current_paragraphs)
+            writer.close(cls_id=cls_id, sep_id=sep_id, fingerprint=fingerprint,
+                         input_hash=file_hash(input_file), input_stat=input_stat)
+            store = ParagraphStore.load(paragraph_save_path)
+
+    windows = store.windows(max_seq_length=args.max_seq_length, doc_stride=args.doc_stride,
+                            max_query_length=args.max_query_length,
+                            max_n_answers=args.max_n_answers)
+    logger.info("# of features per paragraph: %.1f" % (
+        len(windows) / max(len(store.columns['paragraph_length']), 1)))
+    return windows
+
+
+class ShardPrefetcher(object):
+    """Builds the dataloaders of upcoming training files on a background thread
+    while the current one is used for training.
+
+    `load_fn(input_file)` is called for each of `input_files` in order; at most
+    `max_prefetch` of them are loaded (or being loaded) ahead of the one the
+    caller holds. `next` returns them in order and logs how long it waited.
+    """
+
+    def __init__(self, logger, load_fn, input_files, max_prefetch=1):
+        self.logger = logger
+        self.load_fn = load_fn
+        self.input_files = list(input_files)
+        self.results = queue.Queue()
+        self.slots = threading.Semaphore(max_prefetch)
+        self.closed = False
+        self.total_wait = 0.0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        for input_file in self.input_files:
+            self.slots.acquire()
+            if self.closed:
+                return
+            try:
+                self.results.put((input_file, self.load_fn(input_file), None))
+            except Exception as e:
+                self.results.put((input_file, None, e))
+                return
+
+    def next(self):
+        start = time.time()
+        input_file, result, error = self.results.get()
+        # The caller drops its previous shard now, so the next one can be loaded.
+        self.slots.release()
+        if error is not None:
+            raise error
+        wait = time.time() - start
+        self.total_wait += wait
+        self.logger.info("Waited %.2fs for training data from %s (%.2fs in total)" % (
+            wait, input_file, self.total_wait))
+        return result
+
+    def close(self):
+        self.closed = True
+        self.slots.release()
+
+
+def _feature_fingerprint(args, tokenizer, max_n_answers, is_training):
+    """Hash of the tokenizer vocab and of every parameter features depend on."""
+    settings = dict(vocab=tokenization.vocab_fingerprint(tokenizer.vocab),
+                    do_lower_case=tokenizer.basic_tokenizer.do_lower_case,
+                    max_seq_length=args.max_seq_length,
+                    doc_stride=args.doc_stride,
+                    max_query_length=args.max_query_length,
+                    max_n_answers=max_n_answers,
+                    is_training=is_training,
+                    store_version=STORE_VERSION)
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+
+def _paragraph_fingerprint(tokenizer):
+    """Hash of the tokenizer vocab and settings a `ParagraphStore` depends on."""
+    settings = dict(vocab=tokenization.vocab_fingerprint(tokenizer.vocab),
+                    do_lower_case=tokenizer.basic_tokenizer.do_lower_case,
+                    lazy_windows=True)
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
 
 def read_squad_examples(logger, args, input_file, debug):
+    return list(iter_squad_examples(logger, args, input_file, debug))
+
+def iter_squad_examples(logger, args, input_file, debug):
+    """Yields a `SquadExample` per line of the (comma-separated) input files,
+    reading and parsing one line at a time. With `debug`, stops after the first
+    50 lines of each file."""
     def _process_sent(sent):
         if type(sent) != str:
             return [_process_sent(s) for s in sent]
         return sent.replace('–', '-').replace('&', 'and').replace('&amp;', 'and')
 
-    input_data = []
-    for _input_file in input_file.split(','):
-        logger.info("Loading {}".format(_input_file))
-        with open(_input_file, "r") as f:
-            this_data = [json.loads(line) for line in f.readlines()]
-            if debug:
-                this_data = this_data[:50]
-            input_data += this_data
+    def _iter_entries():
+        for _input_file in input_file.split(','):
+            logger.info("Loading {}".format(_input_file))
+            with open(_input_file, "r") as f:
+                for (line_index, line) in enumerate(f):
+                    if debug and line_index == 50:
+                        break
+                    yield json.loads(line)
 
     def is_whitespace(c):
         if c == " " or c == "\t" or c == "\r" or c == "\n" or ord(c) == 0x202F:
             return True
         return False
 
-    examples = []
+    input_data = _iter_entries()
     if args.verbose:
         input_data = tqdm(input_data)
+    compute_stats = "test" not in input_file
+    n_answers = []
     for entry in input_data:
 
         doc_tokens_list1, char_to_word_offset_list = [], []
@@ -131,7 +339,13 @@ def read_squad_examples(logger, args, input_file, debug):
             end_positions_list.append(end_positions)
             switches_list.append(switches)
 
-        examples.append(SquadExample(
+        if compute_stats:
+            for switches in switches_list:
+                assert 0 in switches or switches==[3]
+                if 0 in switches:
+                    n_answers.append(len(switches))
+
+        yield SquadExample(
                 qas_id=entry['id'],
                 question_text=entry['question'],
                 doc_tokens=entry['context'],
@@ -140,207 +354,346 @@ def read_squad_examples(logger, args, input_file, debug):
                 all_answers=entry['final_answers'],
                 start_position=start_positions_list,
                 end_position=end_positions_list,
-                switch=switches_list))
-    if "test" in input_file:
-        return examples
-    n_answers = []
-    for example in examples:
-        has_answer=False
-        for switches in example.switch:
-            assert 0 in switches or switches==[3]
-            if 0 in switches:
-                n_answers.append(len(switches))
-    logger.info("# answers  = %.1f %.1f %.1f %.1f" %(
-        np.mean(n_answers), np.median(n_answers),
-        np.percentile(n_answers, 95), np.percentile(n_answers, 99)))
-    return examples
+                switch=switches_list)
+    if compute_stats:
+        logger.info("# answers  = %.1f %.1f %.1f %.1f" %(
+            np.mean(n_answers), np.median(n_answers),
+            np.percentile(n_answers, 95), np.percentile(n_answers, 99)))
 
 def convert_examples_to_features(logger, args, examples, tokenizer, max_seq_length,
                                  doc_stride, max_query_length, max_n_answers, is_training):
     """Loads a data file into a list of `InputBatch`s."""
+    return list(iter_features(logger, args, examples, tokenizer, max_seq_length,
+                              doc_stride, max_query_length, max_n_answers, is_training))
+
+def iter_features(logger, args, examples, tokenizer, max_seq_length,
+                  doc_stride, max_query_length, max_n_answers, is_training, cache=None):
+    """Yields the list of features of each example, consuming `examples` lazily.
+
+    With `args.num_prepro_workers > 1`, examples are converted in a process pool,
+    `CONVERT_WINDOW_SIZE` examples at a time so that only one window is held in
+    memory. Results are merged in example order and `unique_id`s are assigned
+    afterwards, so the output is identical to the serial path.
+
+    With a `FeatureCache`, the saved features of examples found in it are
+    reused instead of being converted again.
+    """
 
     unique_id = 1000000000
 
     truncated = []
-    features = []
-    features_with_truncated_answers = []
 
-    if args.verbose:
-        examples = tqdm(enumerate(examples))
+    convert_kwargs = dict(tokenizer=tokenizer, max_seq_length=max_seq_length,
+                          doc_stride=doc_stride, max_query_length=max_query_length,
+                          max_n_answers=max_n_answers, is_training=is_training)
+    num_workers = args.num_prepro_workers
+
+    # Pairs of an indexed example and its cached result (None if it has to be converted).
+    items = ((indexed_example, _lookup_cache(cache, indexed_example[1])) \
+             for indexed_example in enumerate(examples))
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers, initializer=_init_convert_worker,
+                                    initargs=(convert_kwargs,))
+        results = _imap_windows(pool, _convert_example_in_worker, items,
+                                tokenizer.wordpiece_tokenizer.cache)
     else:
-        examples = enumerate(examples)
+        pool = None
+        results = (result if result is not None else \
+                   _convert_example_to_features(example_index, example, **convert_kwargs) \
+                   for ((example_index, example), result) in items)
 
-    for (example_index, example) in examples:
-        query_tokens = tokenizer.tokenize(example.question_text)
+    if args.verbose:
+        results = tqdm(results)
 
-        if len(query_tokens) > max_query_length:
-            query_tokens = query_tokens[0:max_query_length]
+    for (example_index, (current_features, current_truncated)) in enumerate(results):
+        for feature in current_features:
+            feature.unique_id = unique_id
+            feature.example_index = example_index
+            unique_id += 1
+        truncated += current_truncated
+        yield current_features
 
-        assert len(example.doc_tokens) == len(example.orig_answer_text) == \
-            len(example.start_position) == len(example.end_position) == len(example.switch)
+    if pool is not None:
+        pool.close()
+        pool.join()
 
-        current_features =  []
+    logger.info("# of features per paragraph: %.1f"%(np.mean(truncated)))
 
-        for (paragraph_index, doc_tokens, original_answer_text_list, start_position_list, end_position_list, switch_list) in \
-                zip(example.paragraph_indices, example.doc_tokens, example.orig_answer_text, example.start_position, \
-                    example.end_position, example.switch):
-            tok_to_orig_index = []
-            orig_to_tok_index = []
-            all_doc_tokens = []
-            for (i, token) in enumerate(doc_tokens):
-                orig_to_tok_index.append(len(all_doc_tokens))
-                sub_tokens = tokenizer.tokenize([token], basic_done=True)
-                for sub_token in sub_tokens:
-                    tok_to_orig_index.append(i)
-                    all_doc_tokens.append(sub_token)
-            tok_start_positions, tok_end_positions = [], []
+def iter_paragraphs(logger, args, examples, tokenizer):
+    """Yields, for each training example, the WordPiece ids of its question and
+    of its paragraphs with their answer spans (see `ParagraphStoreWriter.add`).
+    Uses `args.num_prepro_workers` processes like `iter_features`."""
+    convert_kwargs = dict(tokenizer=tokenizer)
+    num_workers = args.num_prepro_workers
+    items = ((indexed_example, None) for indexed_example in enumerate(examples))
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers, initializer=_init_convert_worker,
+                                    initargs=(convert_kwargs,))
+        results = _imap_windows(pool, _convert_paragraphs_in_worker, items,
+                                tokenizer.wordpiece_tokenizer.cache)
+    else:
+        pool = None
+        results = (_convert_example_to_paragraphs(example, **convert_kwargs) \
+                   for ((_, example), _) in items)
 
-            if is_training:
-                for (orig_answer_text, start_position, end_position) in zip( \
-                            original_answer_text_list, start_position_list, end_position_list):
-                    tok_start_position = orig_to_tok_index[start_position]
-                    if end_position < len(doc_tokens) - 1:
-                        tok_end_position = orig_to_tok_index[end_position + 1] - 1
-                    else:
-                        tok_end_position = len(all_doc_tokens) - 1
-                    (tok_start_position, tok_end_position) = _improve_answer_span(
-                        all_doc_tokens, tok_start_position, tok_end_position, tokenizer,
-                        orig_answer_text)
-                    tok_start_positions.append(tok_start_position)
-                    tok_end_positions.append(tok_end_position)
-                to_be_same = [len(original_answer_text_list), \
-                                    len(start_position_list), len(end_position_list),
-                                    len(switch_list), \
-                                    len(tok_start_positions), len(tok_end_positions)]
-                assert all([x==to_be_same[0] for x in to_be_same])
+    if args.verbose:
+        results = tqdm(results)
+
+    for result in results:
+        yield result
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+CONVERT_WINDOW_SIZE = 1024
+
+def _imap_windows(pool, func, iterable, wordpiece_cache):
+    # `Pool.imap` would read the whole iterable ahead of the workers, so it is
+    # fed one bounded window at a time. Items are `(args, result)` pairs and
+    # `func` only runs on those without a result yet. Workers return each
+    # result with the updates of their WordPiece cache, which are merged into
+    # `wordpiece_cache` in example order.
+    iterator = iter(iterable)
+    while True:
+        window = list(itertools.islice(iterator, CONVERT_WINDOW_SIZE))
+        if len(window) == 0:
+            break
+        computed = pool.imap(func, [args for (args, result) in window if result is None],
+                             chunksize=16)
+        for (args, result) in window:
+            if result is None:
+                result, updates = next(computed)
+                wordpiece_cache.merge_updates(updates)
+            yield result
+
+def _lookup_cache(cache, example):
+    if cache is None:
+        return None
+    features = cache.lookup(example)
+    if features is None:
+        return None
+    # Number of doc spans of each paragraph, as returned by the conversion.
+    truncated = list(collections.Counter(f.paragraph_index for f in features).values())
+    return features, truncated
+
+_convert_worker_kwargs = None
+
+def _init_convert_worker(convert_kwargs):
+    global _convert_worker_kwargs
+    _convert_worker_kwargs = convert_kwargs
+    _convert_worker_kwargs['tokenizer'].wordpiece_tokenizer.cache.track_updates()
+
+def _convert_example_in_worker(indexed_example):
+    example_index, example = indexed_example
+    return (_convert_example_to_features(example_index, example, **_convert_worker_kwargs),
+            _convert_worker_kwargs['tokenizer'].wordpiece_tokenizer.cache.pop_updates())
+
+def _convert_paragraphs_in_worker(indexed_example):
+    return (_convert_example_to_paragraphs(indexed_example[1], **_convert_worker_kwargs),
+            _convert_worker_kwargs['tokenizer'].wordpiece_tokenizer.cache.pop_updates())
+
+def _convert_example_to_paragraphs(example, tokenizer):
+    """Converts one training example into the ids of its (untruncated) question
+    and, for each paragraph, the tuple expected by `ParagraphStoreWriter.add`."""
+    query_ids = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(example.question_text))
+    paragraphs = []
+    for (paragraph_index, doc_tokens, original_answer_text_list, start_position_list, end_position_list, switch_list) in \
+            zip(example.paragraph_indices, example.doc_tokens, example.orig_answer_text, example.start_position, \
+                example.end_position, example.switch):
+        all_doc_tokens, _, orig_to_tok_index = _tokenize_paragraph(doc_tokens, tokenizer)
+        doc_ids = tokenizer.convert_tokens_to_ids(all_doc_tokens)
+        tok_start_positions, tok_end_positions = _tokenize_answer_spans(
+                doc_tokens, doc_ids, orig_to_tok_index, tokenizer,
+                original_answer_text_list, start_position_list, end_position_list)
+        # Yes/no answers are kept at position 0 in every window (see
+        # `_convert_example_to_features`).
+        yes_no = [orig_answer_text in ['yes', 'no'] and switch != 3 \
+                  for (orig_answer_text, switch) in zip(original_answer_text_list, switch_list)]
+        paragraphs.append((paragraph_index, doc_ids, tok_start_positions, tok_end_positions,
+                           switch_list, yes_no))
+    return query_ids, paragraphs
+
+def _convert_example_to_features(example_index, example, tokenizer, max_seq_length,
+                                 doc_stride, max_query_length, max_n_answers, is_training):
+    """Converts one example into its features (without `unique_id`) and the
+    number of doc spans of each of its paragraphs."""
 
+    truncated = []
 
-            # The -3 accounts for [CLS], [SEP] and [SEP]
-            max_tokens_for_doc = max_seq_length - len(query_tokens) - 3
-
-            # We can have documents that are longer than the maximum sequence length.
-            # To deal with this we do a sliding window approach, where we take chunks
-            # of the up to our max length with a stride of `doc_stride`.
-            _DocSpan = collections.namedtuple(  # pylint: disable=invalid-name
-                "DocSpan", ["start", "length"])
-            doc_spans = []
-            start_offset = 0
-            while start_offset < len(all_doc_tokens):
-                length = len(all_doc_tokens) - start_offset
-                if length > max_tokens_for_doc:
-                    length = max_tokens_for_doc
-                doc_spans.append(_DocSpan(start=start_offset, length=length))
-                if start_offset + length == len(all_doc_tokens):
-                    break
-                start_offset += min(length, doc_stride)
-
-            truncated.append(len(doc_spans))
-            for (doc_span_index, doc_span) in enumerate(doc_spans):
-                tokens = []
-                token_to_orig_map = {}
-                token_is_max_context = {}
-                segment_ids = []
-                tokens.append("[CLS]")
-                segment_ids.append(0)
-                for token in query_tokens:
-                    tokens.append(token)
-                    segment_ids.append(0)
-                tokens.append("[SEP]")
+    query_tokens = tokenizer.tokenize(example.question_text)
+
+    if len(query_tokens) > max_query_length:
+        query_tokens = query_tokens[0:max_query_length]
+    query_ids = tokenizer.convert_tokens_to_ids(query_tokens)
+    cls_id, sep_id = tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+
+    assert len(example.doc_tokens) == len(example.orig_answer_text) == \
+        len(example.start_position) == len(example.end_position) == len(example.switch)
+
+    current_features =  []
+
+    for (paragraph_index, doc_tokens, original_answer_text_list, start_position_list, end_position_list, switch_list) in \
+            zip(example.paragraph_indices, example.doc_tokens, example.orig_answer_text, example.start_position, \
+                example.end_position, example.switch):
+        all_doc_tokens, tok_to_orig_index, orig_to_tok_index = _tokenize_paragraph(doc_tokens, tokenizer)
+        doc_ids = tokenizer.convert_tokens_to_ids(all_doc_tokens)
+        tok_start_positions, tok_end_positions = [], []
+
+        if is_training:
+            tok_start_positions, tok_end_positions = _tokenize_answer_spans(
+                    doc_tokens, doc_ids, orig_to_tok_index, tokenizer,
+                    original_answer_text_list, start_position_list, end_position_list)
+            to_be_same = [len(original_answer_text_list), \
+                                len(start_position_list), len(end_position_list),
+                                len(switch_list), \
+                                len(tok_start_positions), len(tok_end_positions)]
+            assert all([x==to_be_same[0] for x in to_be_same])
+
+
+        # The -3 accounts for [CLS], [SEP] and [SEP]
+        max_tokens_for_doc = max_seq_length - len(query_tokens) - 3
+
+        # We can have documents that are longer than the maximum sequence length.
+        # To deal with this we do a sliding window approach, where we take chunks
+        # of the up to our max length with a stride of `doc_stride`.
+        _DocSpan = collections.namedtuple(  # pylint: disable=invalid-name
+            "DocSpan", ["start", "length"])
+        doc_spans = []
+        start_offset = 0
+        while start_offset < len(all_doc_tokens):
+            length = len(all_doc_tokens) - start_offset
+            if length > max_tokens_for_doc:
+                length = max_tokens_for_doc
+            doc_spans.append(_DocSpan(start=start_offset, length=length))
+            if start_offset + length == len(all_doc_tokens):
+                break
+            start_offset += min(length, doc_stride)
+
+        truncated.append(len(doc_spans))
+        max_context_span_index = _compute_max_context_spans(doc_spans, len(all_doc_tokens))
+        tok_to_orig_index = np.array(tok_to_orig_index, dtype=np.int32)
+        # Window layout: [CLS] question [SEP] document span [SEP]
+        doc_offset = len(query_tokens) + 2
+        for (doc_span_index, doc_span) in enumerate(doc_spans):
+            span_end = doc_span.start + doc_span.length
+            n_tokens = doc_offset + doc_span.length + 1
+            input_ids = [cls_id] + query_ids + [sep_id] + doc_ids[doc_span.start:span_end] + [sep_id]
+            segment_ids = [0] * doc_offset + [1] * (doc_span.length + 1)
+            token_to_orig_map = np.full(n_tokens, -1, dtype=np.int32)
+            token_to_orig_map[doc_offset:doc_offset+doc_span.length] = tok_to_orig_index[doc_span.start:span_end]
+            token_is_max_context = np.zeros(n_tokens, dtype=np.bool_)
+            token_is_max_context[doc_offset:doc_offset+doc_span.length] = \
+                    max_context_span_index[doc_span.start:span_end] == doc_span_index
+            input_mask = [1] * len(input_ids)
+            while len(input_ids) < max_seq_length:
+                input_ids.append(0)
+                input_mask.append(0)
                 segment_ids.append(0)
+            assert len(input_ids) == max_seq_length
+            assert len(input_mask) == max_seq_length
+            assert len(segment_ids) == max_seq_length
+
+            start_positions = []
+            end_positions = []
+            switches = []
+            answer_mask = []
+            if is_training:
+                for (orig_answer_text, start_position, end_position, switch, \
+                            tok_start_position, tok_end_position) in zip(\
+                            original_answer_text_list, start_position_list, end_position_list, \
+                            switch_list, tok_start_positions, tok_end_positions):
+                    if orig_answer_text not in ['yes', 'no'] or switch == 3:
+                        # For training, if our document chunk does not contain an annotation
+                        # we throw it out, since there is nothing to predict.
+                        doc_start = doc_span.start
+                        doc_end = doc_span.start + doc_span.length - 1
+                        if (tok_start_position < doc_start or
+                                tok_end_position < doc_start or
+                                tok_start_position > doc_end or tok_end_position > doc_end):
+                            continue
+                        start_position = tok_start_position - doc_start + doc_offset
+                        end_position = tok_end_position - doc_start + doc_offset
+                    else:
+                        start_position, end_position = 0, 0
+                    start_positions.append(start_position)
+                    end_positions.append(end_position)
+                    switches.append(switch)
+                to_be_same = [len(start_positions), len(end_positions), len(switches)]
+                assert all([x==to_be_same[0] for x in to_be_same])
 
-                for i in range(doc_span.length):
-                    split_token_index = doc_span.start + i
-                    token_to_orig_map[len(tokens)] = tok_to_orig_index[split_token_index]
-
-                    is_max_context = _check_is_max_context(doc_spans, doc_span_index,
-                                                        split_token_index)
-                    token_is_max_context[len(tokens)] = is_max_context
-                    tokens.append(all_doc_tokens[split_token_index])
-                    segment_ids.append(1)
-                tokens.append("[SEP]")
-                segment_ids.append(1)
-                input_ids = tokenizer.convert_tokens_to_ids(tokens)
-                input_mask = [1] * len(input_ids)
-                while len(input_ids) < max_seq_length:
-                    input_ids.append(0)
-                    input_mask.append(0)
-                    segment_ids.append(0)
-                assert len(input_ids) == max_seq_length
-                assert len(input_mask) == max_seq_length
-                assert len(segment_ids) == max_seq_length
-
-                start_positions = []
-                end_positions = []
-                switches = []
-                answer_mask = []
-                if is_training:
-                    for (orig_answer_text, start_position, end_position, switch, \
-                                tok_start_position, tok_end_position) in zip(\
-                                original_answer_text_list, start_position_list, end_position_list, \
-                                switch_list, tok_start_positions, tok_end_positions):
-                        if orig_answer_text not in ['yes', 'no'] or switch == 3:
-                            # For training, if our document chunk does not contain an annotation
-                            # we throw it out, since there is nothing to predict.
-                            doc_start = doc_span.start
-                            doc_end = doc_span.start + doc_span.length - 1
-                            if (tok_start_position < doc_start or
-                                    tok_end_position < doc_start or
-                                    tok_start_position > doc_end or tok_end_position > doc_end):
-                                continue
-                            doc_offset = len(query_tokens) + 2
-                            start_position = tok_start_position - doc_start + doc_offset
-                            end_position = tok_end_position - doc_start + doc_offset
-                        else:
-                            start_position, end_position = 0, 0
-                        start_positions.append(start_position)
-                        end_positions.append(end_position)
-                        switches.append(switch)
-                    to_be_same = [len(start_positions), len(end_positions), len(switches)]
-                    assert all([x==to_be_same[0] for x in to_be_same])
-
-                    if sum(to_be_same) == 0:
-                        start_positions = [0]
-                        end_positions = [0]
-                        switches = [3]
-
-                    if len(start_positions) > max_n_answers:
-                        features_with_truncated_answers.append(len(features))
-                        start_positions = start_positions[:max_n_answers]
-                        end_positions = end_positions[:max_n_answers]
-                        switches = switches[:max_n_answers]
-                    answer_mask = [1 for _ in range(len(start_positions))]
-                    for _ in range(max_n_answers-len(start_positions)):
-                        start_positions.append(0)
-                        end_positions.append(0)
-                        switches.append(0)
-                        answer_mask.append(0)
-
-                current_features.append(
-                    InputFeatures(
-                        unique_id=unique_id,
-                        example_index=example_index,
-                        paragraph_index=paragraph_index,
-                        doc_span_index=doc_span_index,
-                        doc_tokens=doc_tokens,
-                        tokens=tokens,
-                        token_to_orig_map=token_to_orig_map,
-                        token_is_max_context=token_is_max_context,
-                        input_ids=input_ids,
-                        input_mask=input_mask,
-                        segment_ids=segment_ids,
-                        start_position=start_positions,
-                        end_position=end_positions,
-                        switch=switches,
-                        answer_mask=answer_mask))
-                unique_id += 1
-        features.append(current_features)
-
-    logger.info("# of features per paragraph: %.1f"%(np.mean(truncated)))
-    return features
-
-def _improve_answer_span(doc_tokens, input_start, input_end, tokenizer,
-                         orig_answer_text):
-    """Returns tokenized answer spans that better match the annotated answer."""
+                if sum(to_be_same) == 0:
+                    start_positions = [0]
+                    end_positions = [0]
+                    switches = [3]
+
+                if len(start_positions) > max_n_answers:
+                    start_positions = start_positions[:max_n_answers]
+                    end_positions = end_positions[:max_n_answers]
+                    switches = switches[:max_n_answers]
+                answer_mask = [1 for _ in range(len(start_positions))]
+                for _ in range(max_n_answers-len(start_positions)):
+                    start_positions.append(0)
+                    end_positions.append(0)
+                    switches.append(0)
+                    answer_mask.append(0)
+
+            current_features.append(
+                InputFeatures(
+                    unique_id=None,
+                    example_index=example_index,
+                    paragraph_index=paragraph_index,
+                    doc_span_index=doc_span_index,
+                    doc_tokens=doc_tokens,
+                    query_tokens=query_tokens,
+                    paragraph_tokens=all_doc_tokens,
+                    doc_span_start=doc_span.start,
+                    doc_span_length=doc_span.length,
+                    token_to_orig_map=token_to_orig_map,
+                    token_is_max_context=token_is_max_context,
+                    input_ids=input_ids,
+                    input_mask=input_mask,
+                    segment_ids=segment_ids,
+                    start_position=start_positions,
+                    end_position=end_positions,
+                    switch=switches,
+                    answer_mask=answer_mask))
+    return current_features, truncated
+
+def _tokenize_paragraph(doc_tokens, tokenizer):
+    """Returns the WordPiece tokens of a paragraph, the index of the word each of
+    them comes from and the index of the first token of each word."""
+    tok_to_orig_index = []
+    orig_to_tok_index = []
+    all_doc_tokens = []
+    for (i, token) in enumerate(doc_tokens):
+        orig_to_tok_index.append(len(all_doc_tokens))
+        sub_tokens = tokenizer.tokenize([token], basic_done=True)
+        for sub_token in sub_tokens:
+            tok_to_orig_index.append(i)
+            all_doc_tokens.append(sub_token)
+    return all_doc_tokens, tok_to_orig_index, orig_to_tok_index
+
+def _tokenize_answer_spans(doc_tokens, doc_ids, orig_to_tok_index, tokenizer,
+                           orig_answer_texts, start_positions, end_positions):
+    """Projects word-level answer spans onto the WordPiece tokens of the paragraph."""
+    input_spans = []
+    for (start_position, end_position) in zip(start_positions, end_positions):
+        tok_start_position = orig_to_tok_index[start_position]
+        if end_position < len(doc_tokens) - 1:
+            tok_end_position = orig_to_tok_index[end_position + 1] - 1
+        else:
+            tok_end_position = len(doc_ids) - 1
+        input_spans.append((tok_start_position, tok_end_position))
+    tok_start_positions, tok_end_positions = [], []
+    for (tok_start_position, tok_end_position) in _improve_answer_spans(
+            doc_ids, input_spans, tokenizer, orig_answer_texts):
+        tok_start_positions.append(tok_start_position)
+        tok_end_positions.append(tok_end_position)
+    return tok_start_positions, tok_end_positions
+
+def _improve_answer_spans(doc_ids, input_spans, tokenizer, orig_answer_texts):
+    """Returns tokenized answer spans that better match the annotated answers."""
 
     # The SQuAD annotations are character based. We first project them to
     # whitespace-tokenized words. But then after WordPiece tokenization, we can
@@ -364,19 +717,41 @@ def _improve_answer_span(doc_tokens, input_start, input_end, tokenizer,
     # the word "Japanese". Since our WordPiece tokenizer does not split
     # "Japanese", we just use "Japanese" as the annotation. This is fairly rare
     # in SQuAD, but does happen.
-    tok_answer_text = " ".join(tokenizer.tokenize(orig_answer_text))
-
-    for new_start in range(input_start, input_end + 1):
-        for new_end in range(input_end, new_start - 1, -1):
-            text_span = " ".join(doc_tokens[new_start:(new_end + 1)])
-            if text_span == tok_answer_text:
-                return (new_start, new_end)
+    #
+    # WordPiece tokens never contain spaces, so a span matches the answer text
+    # exactly when its token ids equal those of the tokenized answer. We look
+    # for the first such span inside each annotated span, only trying start
+    # positions whose token is the first token of the answer.
+    positions_by_id = collections.defaultdict(list)
+    for (position, token_id) in enumerate(doc_ids):
+        positions_by_id[token_id].append(position)
+
+    answer_ids = {}
+    improved_spans = []
+    for ((input_start, input_end), orig_answer_text) in zip(input_spans, orig_answer_texts):
+        if orig_answer_text not in answer_ids:
+            answer_ids[orig_answer_text] = tokenizer.convert_tokens_to_ids(
+                    tokenizer.tokenize(orig_answer_text))
+        tok_answer_ids = answer_ids[orig_answer_text]
+        n_answer_tokens = len(tok_answer_ids)
+
+        span = (input_start, input_end)
+        if n_answer_tokens > 0:
+            candidates = positions_by_id.get(tok_answer_ids[0], [])
+            for new_start in candidates[bisect.bisect_left(candidates, input_start):]:
+                new_end = new_start + n_answer_tokens - 1
+                if new_end > input_end:
+                    break
+                if doc_ids[new_start:new_end + 1] == tok_answer_ids:
+                    span = (new_start, new_end)
+                    break
+        improved_spans.append(span)
 
-    return (input_start, input_end)
+    return improved_spans
 
 
-def _check_is_max_context(doc_spans, cur_span_index, position):
-    """Check if this is the 'max context' doc span for the token."""
+def _compute_max_context_spans(doc_spans, n_tokens):
+    """Returns, for each token position, the index of its 'max context' doc span."""
 
     # Because of the sliding window approach taken to scoring documents, a single
     # token can appear in multiple documents. E.g.
@@ -394,20 +769,17 @@ def _check_is_max_context(doc_spans, cur_span_index, position):
     # In the example the maximum context for 'bought' would be span C since
     # it has 1 left context and 3 right context, while span B has 4 left context
     # and 0 right context.
-    best_score = None
-    best_span_index = None
+    #
+    # Spans are visited once each, in order, and a span only takes over a
+    # position when it scores strictly higher, so ties go to the earliest span.
+    best_score = np.full(n_tokens, -np.inf)
+    best_span_index = np.full(n_tokens, -1, dtype=np.int64)
     for (span_index, doc_span) in enumerate(doc_spans):
-        end = doc_span.start + doc_span.length - 1
-        if position < doc_span.start:
-            continue
-        if position > end:
-            continue
-        num_left_context = position - doc_span.start
-        num_right_context = end - position
-        score = min(num_left_context, num_right_context) + 0.01 * doc_span.length
-        if best_score is None or score > best_score:
-            best_score = score
-            best_span_index = span_index
-
-    return cur_span_index == best_span_index
-
+        num_left_context = np.arange(doc_span.length)
+        num_right_context = doc_span.length - 1 - num_left_context
+        score = np.minimum(num_left_context, num_right_context) + 0.01 * doc_span.length
+        span_slice = slice(doc_span.start, doc_span.start + doc_span.length)
+        is_better = score > best_score[span_slice]
+        best_score[span_slice][is_better] = score[is_better]
+        best_span_index[span_slice][is_better] = span_index
+    return best_span_index
@@ -6,6 +6,9 @@ from collections import Counter, defaultdict
 class SquadExample(object):
     """A single training/test example for simple sequence classification."""
 
+    __slots__ = ('qas_id', 'question_text', 'doc_tokens', 'paragraph_indices', 'orig_answer_text',
+                 'all_answers', 'start_position', 'end_position', 'switch')
+
     def __init__(self,
                  qas_id,
                  question_text,
@@ -34,6 +37,22 @@ class SquadExample(object):
         return s
 
 class InputFeatures(object):
+    """One window `[CLS] question [SEP] paragraph span [SEP]` of a paragraph.
+
+    Token strings are not copied into each window: `query_tokens` and
+    `paragraph_tokens` are shared by all windows of the same question and
+    paragraph (alternatively `tokens` can be given as a list, or as a sequence
+    like `feature_store.TokenStrings`).
+    `token_to_orig_map` is an int32 array aligned with the tokens, -1 where a
+    token does not come from the paragraph, and `token_is_max_context` is kept
+    as a packed bitmap. Read them through `num_tokens`, `token_text`,
+    `orig_index` and `is_max_context`.
+    """
+
+    __slots__ = ('unique_id', 'example_index', 'paragraph_index', 'doc_span_index', 'doc_tokens',
+                 'query_tokens', 'paragraph_tokens', 'doc_span_start', 'doc_span_length', '_tokens',
+                 'token_to_orig_map', 'token_is_max_context', 'input_ids', 'input_mask',
+                 'segment_ids', 'start_position', 'end_position', 'switch', 'answer_mask')
 
     def __init__(self,
                  unique_id,
@@ -41,6 +60,10 @@ class InputFeatures(object):
                  paragraph_index=None,
                  doc_span_index=None,
                  doc_tokens=None,
+                 query_tokens=None,
+                 paragraph_tokens=None,
+                 doc_span_start=None,
+                 doc_span_length=None,
                  tokens=None,
                  token_to_orig_map=None,
                  token_is_max_context=None,
@@ -56,16 +79,62 @@ class InputFeatures(object):
         self.paragraph_index = paragraph_index
         self.doc_span_index = doc_span_index
         self.doc_tokens = doc_tokens
-        self.tokens = tokens
-        self.token_to_orig_map = token_to_orig_map
-        self.token_is_max_context = token_is_max_context
-        self.input_ids = input_ids
-        self.input_mask = input_mask
-        self.segment_ids = segment_ids
-        self.start_position = start_position
-        self.end_position = end_position
-        self.switch = switch
-        self.answer_mask = answer_mask
+        self.query_tokens = query_tokens
+        self.paragraph_tokens = paragraph_tokens
+        self.doc_span_start = doc_span_start
+        self.doc_span_length = doc_span_length
+        self._tokens = tokens
+        self.token_to_orig_map = _as_array(token_to_orig_map, np.int32)
+        self.token_is_max_context = None if token_is_max_context is None else \
+                np.packbits(np.asarray(token_is_max_context, dtype=np.bool_))
+        self.input_ids = _as_array(input_ids, np.int32)
+        self.input_mask = _as_array(input_mask, np.int8)
+        self.segment_ids = _as_array(segment_ids, np.int8)
+        self.start_position = _as_array(start_position, np.int32)
+        self.end_position = _as_array(end_position, np.int32)
+        self.switch = _as_array(switch, np.int8)
+        self.answer_mask = _as_array(answer_mask, np.int8)
+
+    @property
+    def num_tokens(self):
+        return len(self.token_to_orig_map)
+
+    @property
+    def tokens(self):
+        if self._tokens is not None:
+            return self._tokens
+        return [self._token(i) for i in range(self.num_tokens)]
+
+    def _token(self, i):
+        if self._tokens is not None:
+            return self._tokens[i]
+        n_query = len(self.query_tokens)
+        if i == 0:
+            return "[CLS]"
+        if i <= n_query:
+            return self.query_tokens[i-1]
+        i -= n_query + 2
+        if 0 <= i < self.doc_span_length:
+            return self.paragraph_tokens[self.doc_span_start + i]
+        return "[SEP]"
+
+    def token_text(self, start, end):
+        """Tokens `start` to `end` (inclusive) joined by spaces."""
+        if self._tokens is not None:
+            return " ".join(self._tokens[start:end+1])
+        return " ".join(self._token(i) for i in range(start, end+1))
+
+    def orig_index(self, i):
+        """Index in `doc_tokens` of the word the i-th token comes from, or None."""
+        orig = self.token_to_orig_map[i]
+        return None if orig < 0 else int(orig)
+
+    def is_max_context(self, i):
+        return bool(self.token_is_max_context[i >> 3] & (128 >> (i & 7)))
+
+
+def _as_array(values, dtype):
+    return None if values is None else np.asarray(values, dtype=dtype)
 
 
 def _run_strip_accents(text):
@@ -81,46 +150,62 @@ def _run_strip_accents(text):
 
 
 def find_span_from_text(context, tokens, answer):
-    assert answer in context
+    return find_spans_from_texts(context, tokens, [answer])[0]
+
+def find_spans_from_texts(context, tokens, answers):
+    """Finds the spans of every answer text in `tokens` in a single pass.
+
+    Matches start at a token, so instead of one walk over the tokens per answer,
+    all prefixes of the answers are indexed and each token starts a match only
+    for the answers it is a prefix of; the matches in progress are then extended
+    token by token. Token offsets in `context` are computed once for all answers.
+    Returns, for each of `answers`, the same list of span dicts as a separate
+    search for that answer would.
+    """
+    for answer in answers:
+        assert answer in context
+
+    texts = list(dict.fromkeys(answers))
+    text_index = {answer: a for (a, answer) in enumerate(texts)}
+    prefixes = defaultdict(list)
+    for (a, answer) in enumerate(texts):
+        for end in range(len(answer) + 1):
+            prefixes[answer[:end]].append(a)
 
     offset = 0
-    spans = []
-    scanning = None
-    process = []
+    spans = [[] for _ in texts]
+    # Matches in progress: answer index -> (first word, its offset in `context`).
+    scanning = {}
 
     for i, token in enumerate(tokens):
         token = token.replace(' ##', '').replace('##', '')
-        while context[offset:offset+len(token)]!=token:
-            offset += 1
-            if offset >= len(context):
-                break
-        if scanning is not None:
-            end = offset + len(token)
-            if answer.startswith(context[scanning[-1][-1]:end]):
-                if context[scanning[-1][-1]:end] == answer:
-                    span = (scanning[0][0], i, scanning[0][1])
-                    spans.append(span)
-                elif len(context[scanning[-1][-1]:end]) >= len(answer):
-                    scanning = None
+        found = context.find(token, offset)
+        offset = found if found >= 0 else max(offset + 1, len(context))
+        end = offset + len(token)
+        for a in list(scanning):
+            word_start, start = scanning[a]
+            if not texts[a].startswith(context[start:end]):
+                del scanning[a]
+            elif context[start:end] == texts[a]:
+                spans[a].append((word_start, i, start))
+        for a in prefixes.get(token, []):
+            if a in scanning:
+                continue
+            if token == texts[a]:
+                spans[a].append((i, i, offset))
             else:
-                scanning = None
-        if scanning is None and answer.startswith(token):
-            if token == answer:
-                spans.append((i, i, offset))
-            if token != answer:
-                scanning = [(i, offset)]
+                scanning[a] = (i, offset)
         offset += len(token)
         if offset >= len(context):
             break
-        process.append((token, offset, scanning, spans))
-
-    answers = []
 
-    for word_start, word_end, span in spans:
-        assert context[span:span+len(answer)]==answer or ''.join(tokens[word_start:word_end+1]).replace('##', '')!=answer.replace(' ', '')
-        answers.append({'text': answer, 'answer_start': span, 'word_start': word_start, 'word_end': word_end})
-
-    return answers
+    results = []
+    for answer in answers:
+        results.append([])
+        for word_start, word_end, span in spans[text_index[answer]]:
+            assert context[span:span+len(answer)]==answer or ''.join(tokens[word_start:word_end+1]).replace('##', '')!=answer.replace(' ', '')
+            results[-1].append({'text': answer, 'answer_start': span, 'word_start': word_start, 'word_end': word_end})
+    return results
 
 def detect_span(_answers, context, doc_tokens, char_to_word_offset):
     orig_answer_texts = []
@@ -129,8 +214,8 @@ def detect_span(_answers, context, doc_tokens, char_to_word_offset):
     switches = []
 
     answers = []
-    for answer in _answers:
-        answers += find_span_from_text(context, doc_tokens, answer['text'])
+    for spans in find_spans_from_texts(context, doc_tokens, [answer['text'] for answer in _answers]):
+        answers += spans
 
     for answer in answers:
         orig_answer_text = answer["text"]
@@ -3,6 +3,8 @@ import csv
 import json
 import gzip
 import argparse
+import functools
+import multiprocessing
 
 import numpy as np
 
@@ -12,61 +14,139 @@ from collections import Counter, defaultdict
 title_s = "<title>"
 title_e = "</title>"
 
-def save(data_dir, data, data_type):
-    file_path = os.path.join(data_dir, '{}.json'.format(data_type))
+_decoder = json.JSONDecoder()
+_WHITESPACE = json.decoder.WHITESPACE
+
+def save(data_dir, lines, data_type):
+    """Writes JSON-encoded `lines` to `data_type.jsonl` as they are produced."""
+    file_path = os.path.join(data_dir, '{}.jsonl'.format(data_type))
+    print ("Saving {}".format(file_path))
+    n_lines = 0
     with open(file_path, 'w') as f:
-        print ("Saving {}".format(file_path))
-        json.dump({'data': data}, f)
+        for line in lines:
+            f.write(line + '\n')
+            n_lines += 1
+    return n_lines
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('data_dir', type=str)
+    parser.add_argument('--num_workers', type=int, default=multiprocessing.cpu_count(),
+                        help="number of processes reading shards in parallel")
+    parser.add_argument('--lazy_parsing', action='store_true',
+                        help="only decode the fields and document tokens that are needed")
     args = parser.parse_args()
     for data_type in ['train', 'dev']:
-        prepro_naturalquestions(args.data_dir, data_type)
+        prepro_naturalquestions(args.data_dir, data_type, args.num_workers, args.lazy_parsing)
 
-def prepro_naturalquestions(data_dir, data_type):
-    short_data_list = []
-    for i in range(50 if data_type=='train' else 5):
-        filename = os.path.join(data_dir, 'v1.0', data_type, 'nq-{}-{}.jsonl.gz'.format(data_type, str(i).zfill(2)))
-        print ("Preprocessing {}".format(filename))
-        with gzip.GzipFile(filename, 'r') as fin:
-            json_bytes = fin.read()
-            lines = json_bytes.decode('utf-8').split('\n')
-            lines = [line.strip() for line in lines]
-            lines = [line for line in lines if len(line)>0]
-            for line in tqdm(lines):
-                d = json.loads(line)
-                question = d['question_text']
-                document = [t['token'] for t in d['document_tokens']]
-                answers = []
-                for annotation in d['annotations']:
-                    for short_annotation in annotation['short_answers']:
-                        if short_annotation['end_token']-short_annotation['start_token']>5:
-                            continue
-                        answer = document[short_annotation['start_token']:short_annotation['end_token']]
-                        answers.append(" ".join(answer))
-                if len(answers)>0:
-                    short_data_list.append({
-                        'id': d['example_id'],
-                        'question': question,
-                        'answers': list(set(answers)),
-                        'orig_doc_title': d['document_title']
-                    })
-
-    print (len(short_data_list))
+def prepro_naturalquestions(data_dir, data_type, num_workers=1, lazy_parsing=False):
+    filenames = [os.path.join(data_dir, 'v1.0', data_type, 'nq-{}-{}.jsonl.gz'.format(data_type, str(i).zfill(2)))
+                 for i in range(50 if data_type=='train' else 5)]
+
+    # Shards are read by the workers, but `imap` returns them in order, so the
+    # output (and the permutation below) does not depend on `num_workers`.
+    pool = multiprocessing.Pool(num_workers)
+    shards = tqdm(pool.imap(functools.partial(prepro_shard, lazy_parsing=lazy_parsing), filenames),
+                  total=len(filenames))
+    lines = (json.dumps(d) for short_data_list in shards for d in short_data_list)
 
     if data_type=='dev':
-        save(data_dir, short_data_list, 'test')
+        n_examples = save(data_dir, lines, 'test')
     elif data_type=='train':
+        # Lines are streamed to a temporary file first; the split only keeps
+        # their byte offsets in memory.
+        all_path = os.path.join(data_dir, 'train-all.jsonl.tmp')
+        offsets = []
+        with open(all_path, 'wb') as f:
+            for line in lines:
+                offsets.append(f.tell())
+                f.write((line + '\n').encode('utf-8'))
+        n_examples = len(offsets)
         np.random.seed(1995)
-        indices = np.random.permutation(range(len(short_data_list)))
-        short_data_list = [short_data_list[i] for i in indices]
+        indices = np.random.permutation(range(n_examples))
         n_dev = 8757 # same number of dev data as Lee et al (ACL 2019)
-        save(data_dir, short_data_list[:n_dev], 'dev')
-        save(data_dir, short_data_list[n_dev:], 'train')
+        with open(all_path, 'rb') as f:
+            def _read_lines(indices):
+                for i in indices:
+                    f.seek(offsets[i])
+                    yield f.readline().decode('utf-8').rstrip('\n')
+            save(data_dir, _read_lines(indices[:n_dev]), 'dev')
+            save(data_dir, _read_lines(indices[n_dev:]), 'train')
+        os.remove(all_path)
     else:
         raise NotImplementedError()
+    pool.close()
+    pool.join()
+
+    print (n_examples)
+
+def prepro_shard(filename, lazy_parsing=False):
+    """Returns the questions with short answers of one shard, reading it line by line.
+
+    With `lazy_parsing`, lines are not parsed as a whole: see `LazyRecord`."""
+    short_data_list = []
+    with gzip.open(filename, 'rb') as fin:
+        for line in fin:
+            line = line.decode('utf-8').strip()
+            if len(line)==0:
+                continue
+            if lazy_parsing:
+                d = LazyRecord(line)
+                document = d.document
+            else:
+                d = json.loads(line)
+                document = [t['token'] for t in d['document_tokens']]
+            question = d['question_text']
+            answers = []
+            for annotation in d['annotations']:
+                for short_annotation in annotation['short_answers']:
+                    if short_annotation['end_token']-short_annotation['start_token']>5:
+                        continue
+                    answer = document[short_annotation['start_token']:short_annotation['end_token']]
+                    answers.append(" ".join(answer))
+            if len(answers)>0:
+                short_data_list.append({
+                    'id': d['example_id'],
+                    'question': question,
+                    'answers': list(set(answers)),
+                    'orig_doc_title': d['document_title']
+                })
+    return short_data_list
+
+class LazyRecord(object):
+    """A raw NQ line whose top-level fields are decoded on access.
+
+    `document_tokens` (together with `document_html`, most of the line) is never
+    parsed: `document` only decodes the slices of tokens that are asked for.
+    Keys are located by searching for `"key":`, which cannot occur inside a JSON
+    string since the quotes there are escaped.
+    """
+
+    def __init__(self, line):
+        self.line = line
+        self.document = LazyDocument(line)
+
+    def __getitem__(self, key):
+        start = self.line.find('"%s":' % key)
+        if start < 0:
+            raise KeyError(key)
+        start = _WHITESPACE.match(self.line, start + len(key) + 3).end()
+        return _decoder.raw_decode(self.line, start)[0]
+
+class LazyDocument(object):
+    """The `token` strings of `document_tokens` in a raw NQ line, decoded only
+    for the requested slice."""
+
+    def __init__(self, line):
+        self.line = line
+
+    def __getitem__(self, index):
+        # After splitting on `"token":`, the (i+1)-th piece starts with the
+        # value of the i-th token; pieces after `index.stop` are left unsplit.
+        start = self.line.index('"document_tokens":')
+        pieces = self.line[start:].split('"token":', index.stop)
+        return [_decoder.raw_decode(piece, _WHITESPACE.match(piece).end())[0]
+                for piece in pieces[index.start+1:index.stop+1]]
 
 
 if __name__ == '__main__':
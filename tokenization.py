@@ -19,6 +19,8 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
+import hashlib
+import pickle
 import unicodedata
 import six
 
@@ -81,6 +83,15 @@ def load_vocab(vocab_file):
   return vocab
 
 
+def vocab_fingerprint(vocab):
+  """Returns a hash identifying the contents of a vocabulary."""
+  sha1 = hashlib.sha1()
+  for token in vocab:
+    sha1.update(token.encode("utf-8"))
+    sha1.update(b"\n")
+  return sha1.hexdigest()
+
+
 def convert_tokens_to_ids(vocab, tokens):
   """Converts a sequence of tokens into ids using the vocab."""
   ids = []
@@ -89,6 +100,14 @@ def convert_tokens_to_ids(vocab, tokens):
   return ids
 
 
+def convert_ids_to_tokens(inv_vocab, ids):
+  """Converts a sequence of ids into tokens using the inverse vocab."""
+  tokens = []
+  for i in ids:
+    tokens.append(inv_vocab[i])
+  return tokens
+
+
 def whitespace_tokenize(text):
   """Runs basic whitespace cleaning and splitting on a peice of text."""
   text = text.strip()
@@ -101,10 +120,12 @@ def whitespace_tokenize(text):
 class FullTokenizer(object):
   """Runs end-to-end tokenziation."""
 
-  def __init__(self, vocab_file, do_lower_case=True):
+  def __init__(self, vocab_file, do_lower_case=True, cache_size=100000, cache_policy="lru"):
     self.vocab = load_vocab(vocab_file)
+    self.inv_vocab = {v: k for k, v in self.vocab.items()}
     self.basic_tokenizer = BasicTokenizer(do_lower_case=do_lower_case)
-    self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab)
+    self.wordpiece_tokenizer = WordpieceTokenizer(
+        vocab=self.vocab, cache=WordpieceCache(max_size=cache_size, policy=cache_policy))
 
   def tokenize(self, text, basic_done=False):
     split_tokens = []
@@ -122,6 +143,9 @@ class FullTokenizer(object):
   def convert_tokens_to_ids(self, tokens):
     return convert_tokens_to_ids(self.vocab, tokens)
 
+  def convert_ids_to_tokens(self, ids):
+    return convert_ids_to_tokens(self.inv_vocab, ids)
+
 
 class BasicTokenizer(object):
   """Runs basic tokenization (punctuation splitting, lower casing, etc.)."""
@@ -137,10 +161,20 @@ class BasicTokenizer(object):
   def tokenize(self, text):
     """Tokenizes a piece of text."""
     text = convert_to_unicode(text)
-    text = self._clean_text(text)
+    if _is_ascii(text):
+      text = text.translate(_ASCII_CLEAN_TABLE)
+    else:
+      text = self._clean_text(text)
     orig_tokens = whitespace_tokenize(text)
     split_tokens = []
     for token in orig_tokens:
+      if _is_ascii(token):
+        # ASCII has no accents to strip, so only the case and the punctuation
+        # (looked up in a precomputed table) need handling.
+        if self.do_lower_case:
+          token = token.lower()
+        split_tokens.extend(token.translate(_ASCII_PUNC_TABLE).split())
+        continue
       if self.do_lower_case:
         token = token.lower()
         token = self._run_strip_accents(token)
@@ -194,13 +228,100 @@ class BasicTokenizer(object):
     return "".join(output)
 
 
+class WordpieceCache(object):
+  """Bounded memo of word -> WordPiece sub-tokens.
+
+  Words are evicted in least-recently-used ("lru") or insertion ("fifo") order
+  once `max_size` is reached; `max_size=0` disables the cache. Hits and misses
+  are counted so the hit rate can be logged.
+  """
+
+  def __init__(self, max_size=100000, policy="lru"):
+    if policy not in ("lru", "fifo"):
+      raise ValueError("Unsupported cache policy: %s" % (policy))
+    self.max_size = max_size
+    self.policy = policy
+    self.entries = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    # New entries since the last `pop_updates`, once `track_updates` is called.
+    self.updates = None
+
+  def __len__(self):
+    return len(self.entries)
+
+  def get(self, word):
+    sub_tokens = self.entries.get(word)
+    if sub_tokens is None:
+      self.misses += 1
+      return None
+    self.hits += 1
+    if self.policy == "lru":
+      self.entries.move_to_end(word)
+    return sub_tokens
+
+  def put(self, word, sub_tokens):
+    if self.max_size <= 0:
+      return
+    self.entries[word] = sub_tokens
+    if len(self.entries) > self.max_size:
+      self.entries.popitem(last=False)
+    if self.updates is not None:
+      self.updates.append((word, sub_tokens))
+
+  def track_updates(self):
+    """Starts recording the entries added from now on (see `pop_updates`)."""
+    self.updates = []
+
+  def pop_updates(self):
+    """Returns the entries added and the hits and misses counted since the last
+    call, and resets them. Used by worker processes to send their share of the
+    cache back to the parent, which applies it with `merge_updates`."""
+    updates = (self.updates, self.hits, self.misses)
+    self.updates, self.hits, self.misses = [], 0, 0
+    return updates
+
+  def merge_updates(self, updates):
+    entries, hits, misses = updates
+    for (word, sub_tokens) in entries:
+      self.put(word, sub_tokens)
+    self.hits += hits
+    self.misses += misses
+
+  def hit_rate(self):
+    total = self.hits + self.misses
+    return float(self.hits) / total if total > 0 else 0.0
+
+  def save(self, cache_file, vocab):
+    """Saves the entries, tagged with the vocab they were computed with."""
+    with open(cache_file, "wb") as writer:
+      pickle.dump({"vocab": vocab_fingerprint(vocab),
+                   "entries": list(self.entries.items())}, writer)
+
+  def load(self, cache_file, vocab):
+    """Loads entries saved by `save`. Returns False (and loads nothing) if they
+    were computed with a different vocab."""
+    with open(cache_file, "rb") as reader:
+      saved = pickle.load(reader)
+    if saved["vocab"] != vocab_fingerprint(vocab):
+      return False
+    for (word, sub_tokens) in saved["entries"]:
+      self.put(word, sub_tokens)
+    return True
+
+
 class WordpieceTokenizer(object):
   """Runs WordPiece tokenziation."""
 
-  def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=100):
+  def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=100, cache=None,
+               use_trie=True):
     self.vocab = vocab
     self.unk_token = unk_token
     self.max_input_chars_per_word = max_input_chars_per_word
+    self.cache = cache if cache is not None else WordpieceCache(max_size=0)
+    self.use_trie = use_trie
+    if use_trie:
+      self.word_trie, self.subword_trie = _build_vocab_tries(vocab)
 
   def tokenize(self, text):
     """Tokenizes a piece of text into its word pieces.
@@ -224,36 +345,98 @@ class WordpieceTokenizer(object):
 
     output_tokens = []
     for token in whitespace_tokenize(text):
-      chars = list(token)
-      if len(chars) > self.max_input_chars_per_word:
-        output_tokens.append(self.unk_token)
-        continue
+      sub_tokens = self.cache.get(token)
+      if sub_tokens is None:
+        sub_tokens = tuple(self._tokenize_word(token))
+        self.cache.put(token, sub_tokens)
+      output_tokens.extend(sub_tokens)
+    return output_tokens
 
-      is_bad = False
-      start = 0
-      sub_tokens = []
-      while start < len(chars):
-        end = len(chars)
-        cur_substr = None
-        while start < end:
-          substr = "".join(chars[start:end])
-          if start > 0:
-            substr = "##" + substr
-          if substr in self.vocab:
-            cur_substr = substr
-            break
-          end -= 1
-        if cur_substr is None:
-          is_bad = True
+  def _tokenize_word(self, token):
+    """Runs the greedy longest-match-first search on a single word."""
+    if not self.use_trie:
+      return self._tokenize_word_by_substring(token)
+    if len(token) > self.max_input_chars_per_word:
+      return [self.unk_token]
+
+    sub_tokens = []
+    start = 0
+    trie = self.word_trie
+    while start < len(token):
+      # Walk down the trie as far as the word allows, remembering the last
+      # (i.e. longest) vocab entry passed on the way.
+      node = trie
+      cur_substr = None
+      end = start
+      for i in range(start, len(token)):
+        node = node.get(token[i])
+        if node is None:
+          break
+        if _TRIE_TOKEN in node:
+          cur_substr = node[_TRIE_TOKEN]
+          end = i + 1
+      if cur_substr is None:
+        return [self.unk_token]
+      sub_tokens.append(cur_substr)
+      start = end
+      trie = self.subword_trie
+    return sub_tokens
+
+  def _tokenize_word_by_substring(self, token):
+    """Same as `_tokenize_word`, looking up every candidate substring in the
+    vocab dict instead of walking the trie."""
+    chars = list(token)
+    if len(chars) > self.max_input_chars_per_word:
+      return [self.unk_token]
+
+    is_bad = False
+    start = 0
+    sub_tokens = []
+    while start < len(chars):
+      end = len(chars)
+      cur_substr = None
+      while start < end:
+        substr = "".join(chars[start:end])
+        if start > 0:
+          substr = "##" + substr
+        if substr in self.vocab:
+          cur_substr = substr
           break
-        sub_tokens.append(cur_substr)
-        start = end
+        end -= 1
+      if cur_substr is None:
+        is_bad = True
+        break
+      sub_tokens.append(cur_substr)
+      start = end
+
+    if is_bad:
+      return [self.unk_token]
+    return sub_tokens
+
+
+_TRIE_TOKEN = ""
 
-      if is_bad:
-        output_tokens.append(self.unk_token)
-      else:
-        output_tokens.extend(sub_tokens)
-    return output_tokens
+
+def _build_vocab_tries(vocab):
+  """Builds character tries used to match the start of a word (every vocab
+  entry, verbatim) and its continuation ("##" entries, without the "##"). Each
+  node is a dict from the next character to its child; nodes that complete a
+  vocab entry map `_TRIE_TOKEN` to that entry."""
+  word_trie, subword_trie = {}, {}
+  for token in vocab:
+    _add_to_trie(word_trie, token, token)
+    if token.startswith("##"):
+      _add_to_trie(subword_trie, token[2:], token)
+  return word_trie, subword_trie
+
+
+def _add_to_trie(trie, chars, token):
+  if not chars:
+    return
+  node = trie
+  for char in chars:
+    node = node.setdefault(char, {})
+  node[_TRIE_TOKEN] = token
 
 
 def _is_whitespace(char):
@@ -294,3 +477,32 @@ def _is_punctuation(char):
   if cat.startswith("P"):
     return True
   return False
+
+
+if hasattr(str, "isascii"):
+  _is_ascii = str.isascii
+else:
+  def _is_ascii(text):
+    return all(ord(char) < 128 for char in text)
+
+
+def _ascii_clean_table():
+  """`str.translate` table doing what `_clean_text` does to ASCII text."""
+  table = {}
+  for cp in range(128):
+    char = chr(cp)
+    if cp == 0 or _is_control(char):
+      table[cp] = None
+    elif _is_whitespace(char):
+      table[cp] = " "
+  return table
+
+
+def _ascii_punc_table():
+  """`str.translate` table surrounding ASCII punctuation with spaces, so that
+  splitting on whitespace does what `_run_split_on_punc` does."""
+  return {cp: " %s " % chr(cp) for cp in range(128) if _is_punctuation(chr(cp))}
+
+
+_ASCII_CLEAN_TABLE = _ascii_clean_table()
+_ASCII_PUNC_TABLE = _ascii_punc_table()